@@ -8,3 +8,4 @@ from cg import CG
 import mpi
 import memory
 import point
+import pmat
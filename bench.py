@@ -1,88 +1,151 @@
-# Simple benchmarking utility. Compared to the fortran version, this is
-# not fast enough to be used in tight inner loops, but it will serve my
-# purposes. It keeps a full history of the bencharmking events as a flat
-# list.
-import time, numpy as np
+# Hierarchical profiling utility. Regions are started and stopped by
+# name, either explicitly, with a with-statement or as a decorator,
+# and nest, so that a region "fft" entered inside "cg" is recorded as
+# "cg/fft". For each region the number of calls and the total, minimum
+# and maximum wall and cpu time are accumulated. The raw start/stop
+# events are also kept, in a preallocated ring buffer of fixed size,
+# so memory use doesn't grow with the number of events.
+#
+# When disabled, start, stop and region return immediately, so the
+# profiling calls can be left in inner loops in production. A Bench
+# is meant to be used from a single thread, except for reading
+# current, which is safe from any thread.
+import time, resource, numpy as np
 
-class Bench:
+class Entry:
 	def __init__(self):
-		self.entries = []
+		self.n    = 0
+		self.wall = 0.0
+		self.cpu  = 0.0
+		self.wmin, self.wmax = np.inf, 0.0
+		self.cmin, self.cmax = np.inf, 0.0
+	def add(self, wall, cpu):
+		self.n    += 1
+		self.wall += wall
+		self.cpu  += cpu
+		self.wmin, self.wmax = min(self.wmin, wall), max(self.wmax, wall)
+		self.cmin, self.cmax = min(self.cmin, cpu),  max(self.cmax, cpu)
+
+# Process cpu time. time.clock is deprecated, and os.times only
+# has a resolution of a clock tick.
+def cputime():
+	r = resource.getrusage(resource.RUSAGE_SELF)
+	return r.ru_utime + r.ru_stime
+if hasattr(time, "process_time"): cputime = time.process_time
+
+class Bench:
+	def __init__(self, enabled=True, nevent=0x10000):
+		self.enabled = enabled
+		self.steps   = {}
+		self.stack   = []
+		self.ids     = {}
+		self.names   = []
+		self.estop   = np.zeros(nevent, np.int8)
+		self.eregion = np.zeros(nevent, np.int32)
+		self.ewall   = np.zeros(nevent)
+		self.ecpu    = np.zeros(nevent)
+		self.nevent  = 0
+		self.null    = NullRegion()
 	def start(self, name):
-		self.entries.append([0, time.time(), time.clock(), name])
-	def stop(self, name):
-		self.entries.append([1, time.time(), time.clock(), name])
-	def dump(self, fname, fmt="%d %12.5f %12.5f %s"):
-		f = open(fname, "w")
-		for e in self.entries:
-			print >> f, fmt % tuple(e)
-		f.close()
-#
-#class Entry:
-#	def __init__(self):
-#		self.t  = 0.0
-#		self.dt = 0.0
-#		self.n  = 0
-#
-#class Bench:
-#	def __init__(self):
-#		self.steps = {}
-#	def start(self, name):
-#		if not name in self.steps:
-#			self.steps[name] = Entry()
-#		self.steps[name].t = time.time()
-#	def stop(self, name):
-#		# Finish previous step first
-#		step = self.steps[name]
-#		step.dt += time.time() - step.t
-#		step.n  += 1
-#	def add(self, other):
-#		for k, v in other.steps.iteritems():
-#			if not k in self.steps:
-#				self.steps[k] = v
-#			else:
-#				self.steps[k].dt += v.dt
-#				self.steps[k].n  += v.n
-#	# Reduce collects all information in the
-#	# root node, leaving the others empty.
-#	def reduce(self, comm):
-#		myid  = comm.Get_rank()
-#		nproc = comm.Get_size()
-#		if myid == 0:
-#			for i in range(1, nproc):
-#				self.add(comm.recv(source=i))
-#		else:
-#			comm.send(self, dest=0)
-#			self.steps = {}
-#	def to_str(self, fmt="%-16s %8d %15.7e %15.7e\n"):
-#		keys = sorted(list(self.steps), key=str.lower)
-#		res  = ""
-#		for k in keys:
-#			v = self.steps[k]
-#			res += fmt % (k, v.n, v.dt, v.n and v.dt/v.n or np.nan)
-#		return res
-#	def prt(self, fmt="%-16s %8d %15.7e %15.7e\n"):
-#		print self.to_str(fmt),
-#	def dump(self, fname, fmt="%-16s %8d %15.7e %15.7e\n"):
-#		f = open(fname,"w")
-#		print >> f, self.to_str(fmt),
-#		f.close()
-#
-#def btest(comm):
-#	bench = Bench()
-#	for j in range(10):
-#		bench.start("A")
-#		for i in range(1000): pass
-#		bench.stop("A")
-#		bench.start("B")
-#		for i in range(10000): pass
-#		bench.stop("B")
-#		bench.start("C")
-#		for i in range(100000): pass
-#		bench.stop("C")
-#		bench.start("D")
-#		for i in range(1000000): pass
-#		bench.stop("D")
-#	bench.reduce(comm)
-#	myid = comm.Get_rank()
-#	if myid == 0:
-#		bench.prt()
+		if not self.enabled: return
+		path = self.stack[-1][0] + "/" + name if self.stack else name
+		wall, cpu = time.time(), cputime()
+		self.stack.append((path, name, wall, cpu))
+		self.record(0, path, wall, cpu)
+	# Stop the innermost region, which must be name if specified
+	def stop(self, name=None):
+		if not self.enabled: return
+		wall, cpu = time.time(), cputime()
+		path, name0, wall0, cpu0 = self.stack.pop()
+		if name is not None and name != name0:
+			raise ValueError("Stopping region %s while %s is active" % (name, path))
+		if path not in self.steps: self.steps[path] = Entry()
+		self.steps[path].add(wall-wall0, cpu-cpu0)
+		self.record(1, path, wall, cpu)
+	def record(self, stop, path, wall, cpu):
+		if path not in self.ids:
+			self.ids[path] = len(self.names)
+			self.names.append(path)
+		i = self.nevent % len(self.ewall)
+		self.estop[i], self.eregion[i], self.ewall[i], self.ecpu[i] = stop, self.ids[path], wall, cpu
+		self.nevent += 1
+	# The path of the innermost active region, or None. This may be
+	# called from other threads (see memory.Sampler), so the stack
+	# can be popped between checking it and indexing it.
+	@property
+	def current(self):
+		if not self.enabled: return None
+		try: return self.stack[-1][0]
+		except IndexError: return None
+	def region(self, name):
+		if not self.enabled: return self.null
+		return Region(self, name)
+	# Use as a decorator, profiling each call of the function
+	# as a region with the given name, or the function name.
+	def __call__(self, name=None):
+		def decorator(f):
+			rname = name or f.__name__
+			def wrapper(*args, **kwargs):
+				if not self.enabled: return f(*args, **kwargs)
+				self.start(rname)
+				try: return f(*args, **kwargs)
+				finally: self.stop(rname)
+			wrapper.__name__, wrapper.__doc__ = f.__name__, f.__doc__
+			return wrapper
+		return decorator
+	# The events still in the ring buffer, oldest first, as
+	# [stop,wall,cpu,name]
+	def history(self):
+		n    = len(self.ewall)
+		inds = np.arange(max(0,self.nevent-n), self.nevent) % n
+		return [[self.estop[i], self.ewall[i], self.ecpu[i], self.names[self.eregion[i]]] for i in inds]
+	def dump(self, fname, fmt="%d %17.6f %12.5f %s"):
+		with open(fname, "w") as f:
+			for e in self.history():
+				print >> f, fmt % tuple(e)
+	# Statistics of each region across the tasks of comm, as a dict
+	# of name -> [n, wall, cpu], where each of these is [min,mean,max]
+	# over the tasks (tasks where the region never ran count as 0).
+	# All tasks must take part, and all get the result.
+	def reduce(self, comm):
+		mine  = dict([(k, (v.n, v.wall, v.cpu)) for k, v in self.steps.iteritems()])
+		every = comm.allgather(mine)
+		keys  = set().union(*every)
+		res   = {}
+		for k in keys:
+			vals = np.array([d.get(k, (0,0.0,0.0)) for d in every], dtype=float)
+			res[k] = [[np.min(v), np.mean(v), np.max(v)] for v in vals.T]
+		return res
+	def to_str(self, fmt="%-32s %8d %12.5f %12.5f %12.5f %12.5f\n"):
+		res = "%-32s %8s %12s %12s %12s %12s\n" % ("region", "n", "wall", "wmin", "wmax", "cpu")
+		for k in sorted(self.steps):
+			v = self.steps[k]
+			res += fmt % (k, v.n, v.wall, v.wmin, v.wmax, v.cpu)
+		return res
+	def prt(self):
+		print self.to_str(),
+
+# Format the output of Bench.reduce
+def reduced_str(stats, fmt="%-32s %8.1f %12.5f %12.5f %12.5f %12.5f\n"):
+	res = "%-32s %8s %12s %12s %12s %12s\n" % ("region", "n", "wmin", "wmean", "wmax", "cpu")
+	for k in sorted(stats):
+		n, wall, cpu = stats[k]
+		res += fmt % (k, n[1], wall[0], wall[1], wall[2], cpu[1])
+	return res
+
+class Region:
+	def __init__(self, bench, name):
+		self.bench, self.name = bench, name
+	def __enter__(self):
+		self.bench.start(self.name)
+		return self
+	def __exit__(self, type, value, tb):
+		self.bench.stop(self.name)
+
+class NullRegion:
+	def __enter__(self): return self
+	def __exit__(self, type, value, tb): pass
+
+# A shared, initially disabled, profiler that library code can be
+# instrumented with. Enable it with prof.enabled = True.
+prof = Bench(enabled=False)
@@ -0,0 +1,237 @@
+# Benchmark suite for the performance critical parts of the package,
+# run on synthetic data. Each case is timed over several repetitions,
+# and its latency percentiles, throughput (items per second, where what
+# an item is depends on the case, typically a sample) and peak resident
+# memory (sampled in the background with memory.Sampler) are recorded
+# to a json file. A later run can then be compared to such a baseline,
+# flagging cases that got slower or use more memory. Usage:
+#
+#  python benchmarks.py run [-o results.json] [-q] [-k pattern]
+#  python benchmarks.py compare results.json baseline.json [-t 0.1]
+#
+# Cases that fail, for example due to a missing compiled module, are
+# recorded with their error rather than stopping the suite.
+import numpy as np, time, json, os, sys, socket, tempfile, shutil, argparse
+import bench, memory
+
+# The registered cases, as (name, setup, params). setup(scale, **params)
+# prepares the data and returns (fun, nitem), where fun performs the
+# operation to be timed on nitem items. scale multiplies the problem
+# sizes, and is lowered for quick runs.
+cases = []
+def case(name, *variants):
+	def register(setup):
+		for params in variants or [{}]:
+			cases.append((name % params, setup, params))
+		return setup
+	return register
+
+@case("rfft/ndet=%(ndet)d", dict(ndet=1), dict(ndet=32), dict(ndet=512))
+def bench_rfft(scale, ndet):
+	import misc
+	a = np.random.standard_normal((ndet, int(0x10000*scale)))
+	misc.rfft(a)
+	return lambda: misc.rfft(a), a.size
+
+@case("irfft/ndet=%(ndet)d", dict(ndet=1), dict(ndet=32), dict(ndet=512))
+def bench_irfft(scale, ndet):
+	import misc
+	n  = int(0x10000*scale)
+	fa = misc.rfft(np.random.standard_normal((ndet, n)))
+	misc.irfft(fa, n)
+	return lambda: misc.irfft(fa, n), ndet*n
+
+def smooth_func(x):
+	return np.array([np.sin(3*x[:,0])*np.cos(2*x[:,1]), x[:,0]*x[:,1],
+		np.cos(x[:,0]+x[:,1]), np.exp(-x[:,1])]).T
+
+@case("ndinterpol/eval")
+def bench_interpol_eval(scale):
+	import ndinterpol
+	ip = ndinterpol.build_interpol([[0,0],[1,1]], smooth_func, 1e-6)
+	x  = np.random.uniform(0, 1, (int(1e6*scale),2))
+	return lambda: ip(x), len(x)
+
+@case("ndinterpol/build")
+def bench_interpol_build(scale):
+	import ndinterpol
+	return lambda: ndinterpol.build_interpol([[0,0],[1,1]], smooth_func, 1e-6*scale**-2), 1
+
+# Scan at 100 Hz from a site in the Atacama
+def scan_coords(nsamp):
+	t = np.arange(nsamp)/100.0
+	return np.array([55000 + t/86400, 1 + 0.2*np.sin(2*np.pi*t/20), np.pi/2-0.8+0*t]).T
+
+@case("point/hor2equ")
+def bench_hor2equ(scale):
+	import point, misc
+	site = misc.Bunch(lon=-67.79*misc.degree, lat=-22.96*misc.degree, alt=5080.0,
+		T=273.0, P=550.0, hum=0.2, freq=150.0)
+	coords = scan_coords(int(1e6*scale))
+	return lambda: point.hor2equ(site)(coords), len(coords)
+
+@case("point/rot_polang")
+def bench_rot_polang(scale):
+	import point
+	rot    = point.rot_polang(point.equ2gal())
+	coords = scan_coords(int(1e6*scale))
+	return lambda: rot(coords), len(coords)
+
+# Fixed number of iterations on a dense SPD matrix with condition
+# number 1000
+@case("cg/n=%(n)d", dict(n=500), dict(n=4000))
+def bench_cg(scale, n, niter=50):
+	import cg
+	n = int(n*scale**0.5)
+	q = np.linalg.qr(np.random.standard_normal((n,n)))[0]
+	A = (q*np.logspace(0,3,n)).dot(q.T)
+	b = np.random.standard_normal(n)
+	def run():
+		solver = cg.CG(A.dot, b)
+		for i in range(niter): solver.step()
+	return run, niter
+
+@case("modes/find_common_mode/m=%(m)d", dict(m=1), dict(m=3))
+def bench_common_mode(scale, m, ndet=256):
+	import modes
+	nsamp = int(0x10000*scale)
+	d = np.random.standard_normal((ndet,m)).dot(np.random.standard_normal((m,nsamp)))
+	d += 0.1*np.random.standard_normal(d.shape)
+	return lambda: modes.find_common_mode(d, m), d.size
+
+def test_map(scale):
+	n = int(1024*scale**0.5)
+	m = np.zeros((3,n,2*n))
+	m[:,n/4:3*n/4] = np.random.standard_normal((3,n/2,2*n))
+	return m, np.array([[0,-0.5],[1,0.5]])
+
+@case("mapio/write/%(mode)s", dict(mode="plain"), dict(mode="gzip", compression="gzip", nthread=4))
+def bench_write_map(scale, mode, **kwargs):
+	import mapio
+	m, box = test_map(scale)
+	fname  = os.path.join(tmpdir, "write_%s.hdf" % mode)
+	return lambda: mapio.write_map(fname, m, box, **kwargs), m.size
+
+@case("mapio/read/%(mode)s", dict(mode="full"), dict(mode="sub", pixbox=[[0,0],[256,256]], comps=0))
+def bench_read_map(scale, mode, **kwargs):
+	import mapio
+	m, box = test_map(scale)
+	fname  = os.path.join(tmpdir, "read.hdf")
+	mapio.write_map(fname, m, box)
+	n = mapio.read_map(fname, **kwargs)[0].size
+	return lambda: mapio.read_map(fname, **kwargs), n
+
+tmpdir = None
+
+# Time fun, calling it at least nrep times and for at least mintime
+# seconds in total (but at most maxrep times), after a warm-up call.
+# Returns the individual call durations.
+def measure(fun, nrep=5, mintime=1.0, maxrep=1000):
+	fun()
+	times = []
+	t0 = time.time()
+	while len(times) < maxrep and (len(times) < nrep or time.time()-t0 < mintime):
+		t1 = time.time()
+		fun()
+		times.append(time.time()-t1)
+	return np.array(times)
+
+# Run the cases whose name contains one of patterns (all by default),
+# returning the results as a dict that can be stored as json.
+def run(patterns=None, scale=1.0, nrep=5, mintime=1.0, interval=0.002, verbose=True):
+	global tmpdir
+	tmpdir  = tempfile.mkdtemp()
+	prof    = bench.Bench()
+	sampler = memory.Sampler(prof, interval=interval)
+	res = {"meta": {"time": time.time(), "host": socket.gethostname(), "python": sys.version.split()[0],
+		"numpy": np.__version__, "scale": scale}, "cases": {}}
+	if verbose: print "%-36s %6s %10s %10s %10s %13s %11s" % ("case", "nrep", "p50", "p90", "p99", "throughput", "peak")
+	try:
+		with sampler:
+			for name, setup, params in cases:
+				if patterns and not any([p in name for p in patterns]): continue
+				np.random.seed(0)
+				try:
+					fun, nitem = setup(scale, **params)
+					base = memory.rss()
+					with prof.region(name):
+						times = measure(fun, nrep, mintime)
+					peak = max(sampler.report().get(name, [0,0,0])[2], memory.rss())
+					res["cases"][name] = {"nitem": nitem, "nrep": len(times),
+						"min": np.min(times), "mean": np.mean(times), "p50": np.percentile(times, 50),
+						"p90": np.percentile(times, 90), "p99": np.percentile(times, 99),
+						"throughput": nitem/np.percentile(times, 50), "peak_rss": peak, "peak_delta": peak-base}
+					if verbose: print format_case(name, res["cases"][name])
+				except Exception as e:
+					res["cases"][name] = {"error": "%s: %s" % (type(e).__name__, e)}
+					if verbose: print "%-36s %s" % (name, res["cases"][name]["error"])
+	finally:
+		shutil.rmtree(tmpdir)
+	return res
+
+def format_case(name, r):
+	return "%-36s %6d %10.3e %10.3e %10.3e %10.3e /s %8.1f MB" % (name, r["nrep"], r["p50"], r["p90"],
+		r["p99"], r["throughput"], r["peak_delta"]/2.**20)
+
+# Compare the results new to the baseline base. A case regresses if
+# its median latency grew by more than a fraction tol, or its extra
+# peak memory grew by more than a fraction mtol and at least mmin bytes.
+# A case that succeeded in the baseline but failed in the new results
+# also counts as a regression, while cases missing from either (for
+# example due to -k) are only reported. Prints a table and returns the
+# names of the regressed cases.
+def compare(new, base, tol=0.1, mtol=0.2, mmin=2**24, verbose=True):
+	regressed = []
+	if verbose: print "%-36s %10s %10s %7s %9s %9s" % ("case", "base p50", "new p50", "ratio", "base MB", "new MB")
+	for name in sorted(set(new["cases"]) | set(base["cases"])):
+		a, b = base["cases"].get(name), new["cases"].get(name)
+		if b is not None and "error" in b and a is not None and "error" not in a:
+			regressed.append(name)
+			if verbose: print "%-36s FAILED: %s" % (name, b["error"])
+			continue
+		if a is None or b is None or "error" in a or "error" in b:
+			if verbose: print "%-36s %s" % (name, "missing or failed in " +
+				("baseline" if a is None or "error" in a else "new results"))
+			continue
+		ratio = b["p50"]/a["p50"]
+		flags = []
+		if ratio > 1+tol: flags.append("SLOWER")
+		elif ratio < 1/(1+tol): flags.append("faster")
+		if b["peak_delta"] > a["peak_delta"]*(1+mtol) and b["peak_delta"]-a["peak_delta"] > mmin:
+			flags.append("MEMORY")
+		if "SLOWER" in flags or "MEMORY" in flags: regressed.append(name)
+		if verbose: print "%-36s %10.3e %10.3e %7.3f %9.1f %9.1f %s" % (name, a["p50"], b["p50"], ratio,
+			a["peak_delta"]/2.**20, b["peak_delta"]/2.**20, " ".join(flags))
+	return regressed
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Run or compare benchmarks")
+	sub = parser.add_subparsers(dest="command")
+	prun = sub.add_parser("run")
+	prun.add_argument("-o", "--output", default="benchmarks.json")
+	prun.add_argument("-k", "--pattern", action="append")
+	prun.add_argument("-q", "--quick", action="store_true")
+	prun.add_argument("-s", "--scale", type=float, default=1.0)
+	prun.add_argument("-n", "--nrep", type=int, default=5)
+	pcmp = sub.add_parser("compare")
+	pcmp.add_argument("new")
+	pcmp.add_argument("baseline")
+	pcmp.add_argument("-t", "--tol", type=float, default=0.1)
+	pcmp.add_argument("-m", "--mtol", type=float, default=0.2)
+	args = parser.parse_args(argv)
+	if args.command == "run":
+		scale = args.scale/16 if args.quick else args.scale
+		res = run(args.pattern, scale=scale, nrep=args.nrep, mintime=0.2 if args.quick else 1.0)
+		with open(args.output, "w") as f:
+			json.dump(res, f, indent=1, sort_keys=True)
+	else:
+		with open(args.new) as f: new = json.load(f)
+		with open(args.baseline) as f: base = json.load(f)
+		regressed = compare(new, base, args.tol, args.mtol)
+		if regressed:
+			print "%d regression(s)" % len(regressed)
+			return 1
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -16,35 +16,51 @@
 
 import numpy as np
 
-def default_M(x):     return np.copy(x)
+def default_M(x, out=None):
+	if out is None: return np.copy(x)
+	out[...] = x
 def default_dot(a,b): return a.dot(b)
+def default_dots(pairs): return [a.dot(b) for a,b in pairs]
+def default_coldot(a,b): return np.sum(a*b, tuple(range(1,a.ndim)))
 
 class CG:
 	"""A simple Preconditioner Conjugate gradients solver. Solves
 	the equation system Ax=b."""
-	def __init__(self, A, b, x0=None, M=default_M, dot=default_dot):
+	def __init__(self, A, b, x0=None, M=default_M, dot=default_dot, inplace=False):
 		"""Initialize a solver for the system Ax=b, with a starting guess of x0 (0
 		if not provided). Vectors b and x0 must provide addition and multiplication,
 		as well as the .copy() method, such as provided by numpy arrays. The
 		preconditioner is given by M. A and M must be functors acting on vectors
 		and returning vectors. The dot product may be manually specified using the
-		dot argument. This is useful for MPI-parallelization, for example."""
+		dot argument. This is useful for MPI-parallelization, for example.
+
+		If inplace is True, A and M are instead called as A(x, out) and M(x, out),
+		and must write their result to out. All work vectors are then allocated
+		up front and updated in place, so no memory is allocated while iterating."""
 		# Init parameters
 		self.A   = A
 		self.b   = b
 		self.M   = M
 		self.dot = dot
-		if x0 == None:
+		self.inplace = inplace
+		if x0 is None:
 			self.x = np.zeros(b.shape)
 		else:
 			self.x   = np.copy(x0)
 		# Internal work variables
 		n = b.size
-		self.r   = b-self.A(self.x)
-		self.z   = self.M(self.r)
+		if inplace:
+			self.r, self.z, self.Ap = [np.empty(b.shape) for i in range(3)]
+			self.A(self.x, self.r)
+			np.subtract(b, self.r, self.r)
+			self.M(self.r, self.z)
+			self.p = self.z.copy()
+		else:
+			self.r   = b-self.A(self.x)
+			self.z   = self.M(self.r)
+			self.p   = self.z
 		self.rz  = self.dot(self.r, self.z)
 		self.rz0 = float(self.rz)
-		self.p   = self.z
 		self.err = np.inf
 		self.d   = 4
 		self.arz = []
@@ -55,6 +71,7 @@ class CG:
 		and .err being updated. To solve the system, call step() in
 		a loop until you are satisfied with the accuracy. The result
 		can then be read off from .x."""
+		if self.inplace: return self.step_inplace()
 		Ap = self.A(self.p)
 		alpha = self.rz/self.dot(self.p, Ap)
 		self.x += alpha*self.p
@@ -65,6 +82,25 @@ class CG:
 		beta = next_rz/self.rz
 		self.rz = next_rz
 		self.p = self.z + beta*self.p
+		self.finish_step(alpha)
+	# Same as step, but without any temporary vectors. Ap
+	# doubles as scratch space once r has been updated.
+	def step_inplace(self):
+		self.A(self.p, self.Ap)
+		alpha = self.rz/self.dot(self.p, self.Ap)
+		self.Ap *= alpha
+		self.r  -= self.Ap
+		np.multiply(self.p, alpha, self.Ap)
+		self.x  += self.Ap
+		self.M(self.r, self.z)
+		next_rz = self.dot(self.r, self.z)
+		self.err = next_rz/self.rz0
+		beta = next_rz/self.rz
+		self.rz = next_rz
+		self.p *= beta
+		self.p += self.z
+		self.finish_step(alpha)
+	def finish_step(self, alpha):
 		self.arz.append(self.rz*alpha)
 		# Update proper error
 		if len(self.arz) > self.d:
@@ -75,7 +111,7 @@ class CG:
 class BCG:
 	"""A simple Preconditioner Biconjugate gradients stabilized solver. Solves
 	the equation system Ax=b, where A is a (possibly asymmetric) matrix."""
-	def __init__(self, A, b, x0=None, M=default_M, M2=default_M, dot=default_dot):
+	def __init__(self, A, b, x0=None, M=default_M, M2=default_M, dot=default_dot, inplace=False):
 		"""Initialize a solver for the system Ax=b, with a starting guess of x0 (0
 		if not provided). Vectors b and x0 must provide addition and multiplication,
 		as well as the .copy() method, such as provided by numpy arrays. The
@@ -83,22 +119,31 @@ class BCG:
 		M1 and M2 are the left and right preconditioners respectively. A, M and M2
 		must all be functors acting on vectors and returning vectors. The dot
 		product may be manually specified using the dot argument. This is useful
-		for MPI-parallelization, for example."""
+		for MPI-parallelization, for example. If inplace is True, A, M and M2 are
+		called as A(x, out) etc., like for CG."""
 		# Init parameters
 		self.A = A
 		self.b = b
 		self.M = M
 		self.M2 = M2
 		self.dot = dot
-		self.x = x0.copy()
+		self.inplace = inplace
 		self.bnorm = self.dot(b,b)
-		if x0 == None:
+		if x0 is None:
 			self.x = np.zeros(b.shape)
 		else:
 			self.x   = np.copy(x0)
 		# Internal work variables
 		n = b.size
-		self.r  = b-self.A(self.x)
+		if inplace:
+			self.r = np.empty(b.shape)
+			self.A(self.x, self.r)
+			np.subtract(b, self.r, self.r)
+			self.Mp, self.s, self.Ms, self.AMs = [np.empty(b.shape) for i in range(4)]
+			if M2 is not default_M:
+				self.M2AMs, self.M2s = np.empty(b.shape), np.empty(b.shape)
+		else:
+			self.r  = b-self.A(self.x)
 		self.rh = self.r.copy()
 		self.rho, self.alpha, self.omega = 1.0, 1.0, 1.0
 		self.AMp, self.p = self.x*0, self.x*0
@@ -112,6 +157,7 @@ class BCG:
 		and .err being updated. To solve the system, call step() in
 		a loop until you are satisfied with the accuracy. The result
 		can then be read off from .x."""
+		if self.inplace: return self.step_inplace()
 		rho        = self.dot(self.rh, self.r)
 		beta       = (rho/self.rho)*(self.alpha/self.omega)
 		self.rho   = rho
@@ -122,11 +168,309 @@ class BCG:
 		s          = self.r - self.alpha*self.AMp
 		Ms         = self.M(s)
 		AMs        = self.A(Ms)
-		self.omega = self.dot(self.M2(AMs),self.M2(s))/self.dot(self.M2(AMs),self.M2(AMs))
+		if self.M2 is default_M: M2AMs, M2s = AMs, s
+		else: M2AMs, M2s = self.M2(AMs), self.M2(s)
+		self.omega = self.dot(M2AMs,M2s)/self.dot(M2AMs,M2AMs)
 		self.x    += self.alpha*Mp + self.omega*Ms
 		self.r     = s - self.omega*AMs
 		self.err   = self.dot(self.r,self.r)/self.bnorm
 		self.i    += 1
+	# Same as step, but updating the preallocated work vectors in place.
+	# s is used as scratch space before it is computed.
+	def step_inplace(self):
+		rho        = self.dot(self.rh, self.r)
+		beta       = (rho/self.rho)*(self.alpha/self.omega)
+		self.rho   = rho
+		np.multiply(self.AMp, self.omega, self.s)
+		self.p    -= self.s
+		self.p    *= beta
+		self.p    += self.r
+		self.M(self.p, self.Mp)
+		self.A(self.Mp, self.AMp)
+		self.alpha = rho/self.dot(self.rh, self.AMp)
+		np.multiply(self.AMp, self.alpha, self.s)
+		np.subtract(self.r, self.s, self.s)
+		self.M(self.s, self.Ms)
+		self.A(self.Ms, self.AMs)
+		if self.M2 is default_M: M2AMs, M2s = self.AMs, self.s
+		else:
+			M2AMs, M2s = self.M2AMs, self.M2s
+			self.M2(self.AMs, M2AMs)
+			self.M2(self.s, M2s)
+		self.omega = self.dot(M2AMs,M2s)/self.dot(M2AMs,M2AMs)
+		self.Mp   *= self.alpha
+		self.x    += self.Mp
+		self.Ms   *= self.omega
+		self.x    += self.Ms
+		np.multiply(self.AMs, self.omega, self.r)
+		np.subtract(self.s, self.r, self.r)
+		self.err   = self.dot(self.r,self.r)/self.bnorm
+		self.i    += 1
+
+class PipeCG:
+	"""A pipelined preconditioned conjugate gradients solver (Ghysels & Vanroose
+	2014). Solves the same systems as CG, but needs only a single global
+	reduction per iteration instead of two, which can also be overlapped with
+	the application of M and A. This is useful when the dot products are
+	distributed, and their latency dominates."""
+	def __init__(self, A, b, x0=None, M=default_M, dots=default_dots):
+		"""Initialize a solver for the system Ax=b, with a starting guess of x0 (0
+		if not provided). A and M are as for CG. Instead of a single dot product,
+		dots takes a list of vector pairs [(a1,b1),(a2,b2),...] and returns the
+		list of their dot products, allowing them all to be computed in a single
+		reduction. For overlap with the following A and M, dots can instead start
+		a nonblocking reduction and return a function that waits for it and then
+		returns the list."""
+		self.A    = A
+		self.b    = b
+		self.M    = M
+		self.dots = dots
+		if x0 is None:
+			self.x = np.zeros(b.shape)
+		else:
+			self.x = np.copy(x0)
+		# Internal work variables
+		self.r  = b-self.A(self.x)
+		self.u  = self.M(self.r)
+		self.w  = self.A(self.u)
+		self.z, self.q, self.s, self.p = [self.x*0 for i in range(4)]
+		self.rz, self.alpha = None, None
+		self.rz0 = None
+		self.err = np.inf
+		self.d   = 4
+		self.arz = []
+		self.err_true = np.inf
+		self.i   = 0
+	def step(self):
+		"""Take a single step in the iteration. Results in .x, .i
+		and .err being updated. To solve the system, call step() in
+		a loop until you are satisfied with the accuracy. The result
+		can then be read off from .x. Due to the pipelining, .err
+		describes the residual from before the step."""
+		res = self.dots([(self.r,self.u),(self.w,self.u)])
+		# Overlap the reduction with the preconditioner and A
+		m = self.M(self.w)
+		n = self.A(m)
+		if callable(res): res = res()
+		rz, wu = res
+		if self.rz0 is None: self.rz0 = float(rz)
+		if self.i > 0:
+			beta  = rz/self.rz
+			alpha = rz/(wu - beta*rz/self.alpha)
+		else:
+			beta  = 0
+			alpha = rz/wu
+		self.z = n + beta*self.z
+		self.q = m + beta*self.q
+		self.s = self.w + beta*self.s
+		self.p = self.u + beta*self.p
+		self.x += alpha*self.p
+		self.r -= alpha*self.s
+		self.u -= alpha*self.q
+		self.w -= alpha*self.z
+		self.err = rz/self.rz0
+		self.rz, self.alpha = rz, alpha
+		self.arz.append(rz*alpha)
+		# Update proper error
+		if len(self.arz) > self.d:
+			# Good estimate of error d steps ago
+			self.err_true = sum(self.arz[-self.d:])
+		self.i += 1
+
+class BlockCG:
+	"""A preconditioned conjugate gradients solver for many right hand sides
+	at once. Solves AX=B, where the columns of X and B are stacked along the
+	first axis. Each column follows its own CG recurrence, but A and M are
+	applied to all the active columns together, so that an expensive A only
+	needs one pass through its data per step. Columns that have converged are
+	dropped from further iterations."""
+	def __init__(self, A, b, x0=None, M=default_M, dot=default_coldot, tol=0):
+		"""Initialize a solver for the system AX=B, where b has shape (k,...) for
+		k right hand sides, with a starting guess of x0 (0 if not provided).
+		A and M must be functors acting on such stacks of vectors (of any number
+		of columns) and returning stacks of vectors. The dot product takes two
+		stacks and returns the array of the k dot products of their columns,
+		and may be manually specified for MPI-parallelization, for example.
+		Columns are dropped once their .err falls below tol."""
+		# Init parameters
+		self.A   = A
+		self.b   = b
+		self.M   = M
+		self.dot = dot
+		self.tol = tol
+		if x0 is None:
+			self.x = np.zeros(b.shape)
+		else:
+			self.x = np.copy(x0)
+		# Internal work variables. These only contain the active columns.
+		self.active = np.arange(b.shape[0])
+		self.r   = b-self.A(self.x)
+		self.z   = self.M(self.r)
+		self.p   = self.z
+		self.rz  = self.dot(self.r, self.z)
+		self.rz0 = np.array(self.rz, dtype=float)
+		self.err = np.where(self.rz0 > 0, np.inf, 0)
+		self.i   = 0
+		self.prune()
+	def step(self):
+		"""Take a single step in the iteration for all active columns.
+		Results in .x, .i, .err and .active being updated. To solve the
+		system, call step() in a loop until .active is empty or you are
+		satisfied with .err. The result can then be read off from .x."""
+		Ap = self.A(self.p)
+		alpha = self.expand(self.rz/self.dot(self.p, Ap))
+		self.x[self.active] += alpha*self.p
+		self.r -= alpha*Ap
+		self.z = self.M(self.r)
+		next_rz = self.dot(self.r, self.z)
+		self.err[self.active] = next_rz/self.rz0[self.active]
+		beta = self.expand(next_rz/self.rz)
+		self.rz = next_rz
+		self.p = self.z + beta*self.p
+		self.i += 1
+		self.prune()
+	# Remove the converged columns from the work variables
+	def prune(self):
+		keep = self.err[self.active] > self.tol
+		if np.all(keep): return
+		self.active = self.active[keep]
+		self.r, self.z, self.p, self.rz = self.r[keep], self.z[keep], self.p[keep], self.rz[keep]
+	# Broadcast per-column scalars against a stack of vectors
+	def expand(self, a):
+		return np.reshape(a, a.shape + (1,)*(self.b.ndim-1))
+
+class DeflatedCG:
+	"""A preconditioned conjugate gradients solver with deflation (Saad et al.
+	2000). The solution is kept M-orthogonal to a recycled subspace W, which
+	typically holds approximate eigenvectors of MA with small eigenvalues from
+	an earlier solve of a related system with the same A and M. Removing these
+	slow directions can greatly reduce the number of iterations needed."""
+	def __init__(self, A, b, x0=None, M=default_M, dot=default_dot, space=None, nstore=20):
+		"""Initialize a solver for the system Ax=b, with a starting guess of x0 (0
+		if not provided). A, M and dot are as for CG. space is a RecycleSpace
+		to deflate, usually built by calling recycle() on the solver of a previous
+		system. To make this possible, the first nstore preconditioned residuals
+		are kept, along with A and M^-1 applied to them."""
+		# Init parameters
+		self.A   = A
+		self.b   = b
+		self.M   = M
+		self.dot = dot
+		self.space  = space or RecycleSpace()
+		self.nstore = nstore
+		if x0 is None:
+			self.x = np.zeros(b.shape)
+		else:
+			self.x   = np.copy(x0)
+		# Internal work variables
+		self.r   = b-self.A(self.x)
+		if len(self.space) > 0:
+			# Start from the solution in the deflated subspace. This
+			# does not require any further applications of A.
+			mu = self.space.solve([self.dot(w, self.r) for w in self.space.W])
+			self.x += self.space.combine(self.space.W, mu)
+			self.r -= self.space.combine(self.space.AW, mu)
+		self.z   = self.M(self.r)
+		self.rz  = self.dot(self.r, self.z)
+		self.rz0 = float(self.rz)
+		self.p   = self.z - self.project(self.z)
+		self.Ap  = None
+		self.beta = 0
+		self.err = np.inf
+		self.d   = 4
+		self.arz = []
+		self.err_true = np.inf
+		self.i   = 0
+		# Stored vectors for recycle: z, Az and M^-1z = r
+		self.Z, self.AZ, self.RZ = [], [], []
+	# Return W mu, with mu = E^-1 (AW)'z. mu is kept in .mu
+	def project(self, z):
+		if len(self.space) == 0: return z*0
+		self.mu = self.space.solve([self.dot(aw, z) for aw in self.space.AW])
+		return self.space.combine(self.space.W, self.mu)
+	def step(self):
+		"""Take a single step in the iteration. Results in .x, .i
+		and .err being updated. To solve the system, call step() in
+		a loop until you are satisfied with the accuracy. The result
+		can then be read off from .x."""
+		Ap = self.A(self.p)
+		if len(self.Z) < self.nstore:
+			# p = z + beta p_prev - W mu, so Az can be recovered from
+			# Ap without applying A again.
+			Az = Ap - self.beta*self.Ap if self.Ap is not None else Ap.copy()
+			if len(self.space) > 0:
+				Az += self.space.combine(self.space.AW, self.mu)
+			self.Z.append(self.z); self.AZ.append(Az); self.RZ.append(self.r.copy())
+		alpha = self.rz/self.dot(self.p, Ap)
+		self.x += alpha*self.p
+		self.r -= alpha*Ap
+		self.z = self.M(self.r)
+		next_rz = self.dot(self.r, self.z)
+		self.err = next_rz/self.rz0
+		self.beta = next_rz/self.rz
+		self.rz = next_rz
+		self.p = self.z + self.beta*self.p - self.project(self.z)
+		self.Ap = Ap
+		self.arz.append(self.rz*alpha)
+		# Update proper error
+		if len(self.arz) > self.d:
+			# Good estimate of error d steps ago
+			self.err_true = sum(self.arz[-self.d:])
+		self.i += 1
+	def recycle(self, nvec=10):
+		"""Return a RecycleSpace spanned by the nvec approximate eigenvectors
+		of MA with the smallest eigenvalues that can be found in the current
+		deflation space and the stored residuals. This uses Rayleigh-Ritz with
+		the M^-1 inner product, in which the preconditioned residuals are
+		orthogonal, so neither A nor M need to be applied again."""
+		C  = self.space.W  + self.Z
+		AC = self.space.AW + self.AZ
+		RC = self.space.RW + self.RZ
+		n  = len(C)
+		G  = np.array([[self.dot(C[i],AC[j]) for j in range(n)] for i in range(n)])
+		F  = np.array([[self.dot(C[i],RC[j]) for j in range(n)] for i in range(n)])
+		G, F = 0.5*(G+G.T), 0.5*(F+F.T)
+		# Orthonormalize with respect to F, dropping degenerate directions,
+		# and then solve the eigenvalue problem in that basis.
+		f, V = np.linalg.eigh(F)
+		good = f > f[-1]*1e-12
+		B  = V[:,good]/f[good]**0.5
+		e, U = np.linalg.eigh(B.T.dot(G).dot(B))
+		Y  = B.dot(U[:,:nvec])
+		W  = [self.space.combine(C, y) for y in Y.T]
+		AW = [self.space.combine(AC, y) for y in Y.T]
+		RW = [self.space.combine(RC, y) for y in Y.T]
+		E  = np.array([[self.dot(w, aw) for aw in AW] for w in W])
+		return RecycleSpace(W, AW, RW, E)
+
+class RecycleSpace:
+	"""The subspace used for deflation in DeflatedCG, given by the vectors W,
+	along with AW and M^-1W (RW), and the matrix E = W'AW."""
+	def __init__(self, W=None, AW=None, RW=None, E=None):
+		self.W  = list(W  if W  is not None else [])
+		self.AW = list(AW if AW is not None else [])
+		self.RW = list(RW if RW is not None else [])
+		self.E  = np.zeros([0,0]) if E is None else np.array(E)
+	def __len__(self): return len(self.W)
+	# Solve E mu = v
+	def solve(self, v): return np.linalg.solve(self.E, v)
+	# Return sum_i coeffs[i]*vecs[i]
+	def combine(self, vecs, coeffs):
+		res = vecs[0]*coeffs[0]
+		for v, c in zip(vecs[1:], coeffs[1:]): res += v*c
+		return res
+	def write(self, fname):
+		np.savez(npz_name(fname), W=np.array(self.W), AW=np.array(self.AW), RW=np.array(self.RW), E=self.E)
+
+def read_recycle_space(fname):
+	data = np.load(npz_name(fname))
+	return RecycleSpace(data["W"], data["AW"], data["RW"], data["E"])
+
+# np.savez appends .npz to file names that don't already end with it,
+# so recycle spaces are always stored with that extension, letting the
+# same name be used for writing and reading them.
+def npz_name(fname):
+	return fname if fname.endswith(".npz") else fname + ".npz"
 
 def cg_test():
 	def A(x): return np.array([[4,1],[1,3]],dtype=float).dot(x)
@@ -142,3 +486,17 @@ def bcg_test():
 	while cg.err > 1e-4:
 		cg.step()
 		print cg.i, cg.err, cg.x
+def pipecg_test():
+	def A(x): return np.array([[4,1],[1,3]],dtype=float).dot(x)
+	b = np.array([1.,2])
+	cg = PipeCG(A, b, x0=np.array([2.,1.]))
+	while cg.err > 1e-4:
+		cg.step()
+		print cg.i, cg.err, cg.x
+def blockcg_test():
+	def A(x): return x.dot(np.array([[4,1],[1,3]],dtype=float).T)
+	b = np.array([[1.,2],[3,4],[0,0]])
+	cg = BlockCG(A, b, tol=1e-4)
+	while len(cg.active) > 0:
+		cg.step()
+		print cg.i, cg.err, cg.x
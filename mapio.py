@@ -1,31 +1,58 @@
-import numpy as np, pyfits, sys, h5py as h5, warnings
+import numpy as np, pyfits, sys, os, zlib, itertools, h5py as h5, warnings
+from multiprocessing.pool import ThreadPool
+from misc import h5forget
 warnings.filterwarnings('ignore')
 
 # Write an (...,ndec,nra) map in the flat-sky equatorial
 # CEA projection with limits given by box [[ra1,ra2],[dec1,dec2]]
-# in radians
-def write_map(fname, data, box, fmt=None):
+# in radians. Extra keyword arguments (chunks, compression, level,
+# nthread) are passed on to write_hdf.
+def write_map(fname, data, box, fmt=None, **kwargs):
 	if fmt == None:
 		if   fname[-5:] == ".fits": fmt = "fits"
 		elif fname[-4:] == ".hdf":  fmt = "hdf"
 	if fmt == "fits":
 		write_fits(fname, data, box)
 	elif fmt == "hdf":
-		write_hdf(fname, data, box)
+		write_hdf(fname, data, box, **kwargs)
 	else:
 		raise ValueError
 
-def read_map(fname, fmt=None):
+# Read a map written by write_map, returning data, box. Only the part of the
+# map given by pixbox, [[x1,y1],[x2,y2]] in (ra,dec) pixel order with the
+# upper limit excluded, or subbox, [[ra1,dec1],[ra2,dec2]] in radians, and
+# the components comps (an index, slice or list into the non-pixel axes)
+# is read, with the returned box adjusted to match. Fits files are
+# memory-mapped and hdf files are read using hyperslabs, so reading a small
+# part of a large map is cheap.
+def read_map(fname, fmt=None, pixbox=None, subbox=None, comps=None):
 	if fmt == None:
 		if   fname[-5:] == ".fits": fmt = "fits"
 		elif fname[-4:] == ".hdf":  fmt = "hdf"
 	if fmt == "fits":
-		return read_fits(fname)
+		return read_fits(fname, pixbox, subbox, comps)
 	elif fmt == "hdf":
-		return read_hdf(fname)
+		return read_hdf(fname, pixbox, subbox, comps)
 	else:
 		raise ValueError
 
+# Translate the sub-map specification of read_map into the index into a map
+# with the given shape and box, and the box corresponding to it.
+def map_slice(shape, box, pixbox=None, subbox=None, comps=None):
+	n    = np.array(shape[-1:-3:-1])
+	step = (box[1]-box[0])/(n-1)
+	if subbox is not None:
+		pix    = (np.array(subbox)-box[0])/step
+		# Include every pixel the sub-box touches, but don't let
+		# rounding errors add pixels at its edges
+		pixbox = [np.floor(np.min(pix,0)+1e-6), np.ceil(np.max(pix,0)-1e-6)+1]
+	if pixbox is None: pixbox = [[0,0],n]
+	pixbox = np.clip(np.array(pixbox,dtype=int), 0, n)
+	sel = (slice(pixbox[0,1],pixbox[1,1]), slice(pixbox[0,0],pixbox[1,0]))
+	if comps is not None and len(shape) > 2: sel = (comps,) + sel
+	else: sel = (Ellipsis,) + sel
+	return sel, box[0] + (pixbox-[[0,0],[1,1]])*step
+
 # This one implements the general World Coordinate System
 # standard for FITS.
 def write_fits(fname, data, box):
@@ -66,28 +93,105 @@ def write_fits(fname, data, box):
 	hdus = pyfits.HDUList([pyfits.PrimaryHDU(data, header)])
 	hdus.writeto(fname, clobber=True)
 
+# Coordinates of the first and last pixel centers along an axis
 def wcs2range(n, ref, step, center):
-	return [center - (ref-1)*step, center + (n-ref+1)*step]
+	return [center - (ref-1)*step, center + (n-ref)*step]
 
 # This function assums that we are using flat equatorial coordinates.
 # It can be generalized later if needed.
-def read_fits(fname):
-	hdu    = pyfits.open(fname)[0]
-	header = hdu.header
-	box    = np.array([wcs2range(header["NAXIS%d" % i], header["CRPIX%d" % i], header["CDELT%d" % i],
-		header["CRVAL%d" % i]) for i in range(1,3)]).T*np.pi/180
-	print box.shape, box[0], box[1]
-	return np.array(hdu.data), box
+def read_fits(fname, pixbox=None, subbox=None, comps=None):
+	with pyfits.open(fname, memmap=True) as hdus:
+		hdu    = hdus[0]
+		header = hdu.header
+		box    = np.array([wcs2range(header["NAXIS%d" % i], header["CRPIX%d" % i], header["CDELT%d" % i],
+			header["CRVAL%d" % i]) for i in range(1,3)]).T*np.pi/180
+		sel, box = map_slice(hdu.shape, box, pixbox, subbox, comps)
+		return np.array(hdu.data[sel]), box
 
 # Sadly, I don't know of any WCS equivalent for HDF, so this
-# one will just, dump the data and box.
-def write_hdf(fname, data, box):
-	hfile = h5.File(fname,"w")
-	hfile["data"] = data
-	hfile["box"]  = box[:,::-1]*180/np.pi
-	hfile["system"] = "equ"
-	hfile.close()
+# one will just, dump the data and box. By default the data is written
+# as one contiguous dataset. chunks gives the chunk shape, with missing
+# leading axes having length 1, so that by default each component is
+# chunked separately. compression is anything h5py accepts ("gzip",
+# "lzf", ...), with level as its option, and implies chunking. h5py
+# compresses serially, so for gzip with nthread > 1 the chunks are
+# instead deflated in parallel with zlib (which releases the GIL) and
+# written directly, which gives the same file.
+def write_hdf(fname, data, box, chunks=None, compression=None, level=None, nthread=1):
+	data = np.asarray(data)
+	if compression is not None and chunks is None: chunks = (256,256)
+	if chunks is not None:
+		chunks = (1,)*(data.ndim-len(chunks)) + tuple(chunks)
+		chunks = tuple(np.minimum(chunks, data.shape))
+	h5forget(fname)
+	with h5.File(fname,"w") as hfile:
+		if compression == "gzip" and nthread > 1:
+			if level is None: level = 4
+			dset = hfile.create_dataset("data", data.shape, data.dtype, chunks=chunks,
+					compression=compression, compression_opts=level)
+			write_deflated(dset, data, level, nthread)
+		else:
+			hfile.create_dataset("data", data=data, chunks=chunks,
+					compression=compression, compression_opts=level)
+		hfile["box"]  = box[:,::-1]*180/np.pi
+		hfile["system"] = "equ"
+
+# Deflate the chunks of data in parallel and write them to the chunked,
+# gzip-compressed dataset dset. Chunks at the edges are zero-padded to
+# the full chunk shape, as hdf requires.
+def write_deflated(dset, data, level, nthread):
+	chunks = dset.chunks
+	starts = itertools.product(*[range(0,n,c) for n, c in zip(data.shape, chunks)])
+	def deflate(start):
+		sel   = tuple([slice(s,s+c) for s, c in zip(start, chunks)])
+		block = np.zeros(chunks, dset.dtype)
+		part  = data[sel]
+		block[tuple([slice(0,n) for n in part.shape])] = part
+		return start, zlib.compress(block.tostring(), level)
+	pool = ThreadPool(nthread)
+	try:
+		for start, buf in pool.imap(deflate, starts):
+			dset.id.write_direct_chunk(start, buf)
+	finally:
+		pool.close()
+
+# Write a map distributed over the MPI communicator comm, where each
+# rank holds the tile data of the full map with the given shape and box,
+# starting at pixel pixoff [x,y] (ra,dec order, like pixbox in read_map).
+# Ranks without a tile pass data=None. Each rank writes its tile as a
+# normal map file next to fname in parallel, and the root then writes
+# fname itself with a virtual dataset made up of the tiles, which
+# read_map reads like any other hdf map. Extra keyword arguments are
+# passed on to write_hdf for the tiles.
+def write_map_dist(fname, data, box, pixoff, shape, comm, **kwargs):
+	box   = np.array(box, dtype=float)
+	n     = np.array(shape[-1:-3:-1])
+	step  = (box[1]-box[0])/(n-1)
+	root, ext = os.path.splitext(fname)
+	tname = "%s_%03d%s" % (root, comm.rank, ext)
+	info  = None
+	if data is not None:
+		data = np.asarray(data)
+		tn   = np.array(data.shape[-1:-3:-1])
+		tbox = box[0] + np.array([pixoff, np.array(pixoff)+tn-1])*step
+		write_hdf(tname, data, tbox, **kwargs)
+		info = (os.path.basename(tname), tuple(pixoff), data.shape, data.dtype)
+	infos = comm.gather(info)
+	if comm.rank == 0:
+		infos  = [i for i in infos if i is not None]
+		layout = h5.VirtualLayout(shape=tuple(shape), dtype=infos[0][3])
+		for tname, (x, y), tshape, dtype in infos:
+			layout[...,y:y+tshape[-2],x:x+tshape[-1]] = h5.VirtualSource(tname, "data", shape=tshape)
+		h5forget(fname)
+		with h5.File(fname,"w") as hfile:
+			hfile.create_virtual_dataset("data", layout, fillvalue=0)
+			hfile["box"]  = box[:,::-1]*180/np.pi
+			hfile["system"] = "equ"
+	comm.barrier()
 
-def read_hdf(fname):
+def read_hdf(fname, pixbox=None, subbox=None, comps=None):
 	with h5.File(fname,"r") as hfile:
-		return np.array(hfile["data"]), np.array(hfile["box"])[:,::-1]*np.pi/180
+		data = hfile["data"]
+		box  = np.array(hfile["box"])[:,::-1]*np.pi/180
+		sel, box = map_slice(data.shape, box, pixbox, subbox, comps)
+		return np.array(data[sel]), box
@@ -1,5 +1,5 @@
 # Get information about the process's memory usage.
-import resource, os
+import resource, os, time, threading, numpy as np, bench
 
 def current():
 	with open("/proc/%d/statm" % os.getpid(),"r") as f:
@@ -14,3 +14,101 @@ def max():
 
 def dmem(str):
 	print "%10.4f %10.4f %s" % (current()/1024.**3, max()/1024.**3, str)
+
+# Resident set size, which unlike current() and max() is the
+# memory actually in use, and what gets a job OOM-killed.
+def rss():
+	with open("/proc/%d/statm" % os.getpid(),"r") as f:
+		return int(f.readline().split()[1])*resource.getpagesize()
+
+def max_rss():
+	with open("/proc/%d/status" % os.getpid(),"r") as f:
+		for line in f:
+			toks = line.split()
+			if toks[0] == "VmHWM:":
+				return int(toks[1])*1024
+
+# Background memory tracking. A thread samples the rss every
+# interval seconds into a fixed-size ring buffer, and attributes each
+# sample to the innermost active region of the profiler prof (a
+# bench.Bench, by default the shared bench.prof) and all the regions
+# enclosing it, accumulating the number of samples, their mean and the
+# peak rss for each region. Samples taken outside any region go to
+# the region "-". Start and stop it explicitly or use it in a
+# with-statement.
+class Sampler:
+	def __init__(self, prof=None, interval=0.01, nsamp=0x10000):
+		self.prof     = prof or bench.prof
+		self.interval = interval
+		self.times    = np.zeros(nsamp)
+		self.samples  = np.zeros(nsamp, np.int64)
+		self.nsamp    = 0
+		self.stats    = {}
+		self.thread   = None
+		self.done     = threading.Event()
+	def start(self):
+		self.done.clear()
+		self.thread = threading.Thread(target=self.run)
+		self.thread.daemon = True
+		self.thread.start()
+		return self
+	def stop(self):
+		self.done.set()
+		self.thread.join()
+	def __enter__(self): return self.start()
+	def __exit__(self, type, value, tb): self.stop()
+	def run(self):
+		# Keep the file open, rereading it unbuffered for each sample
+		page = resource.getpagesize()
+		fd   = os.open("/proc/%d/statm" % os.getpid(), os.O_RDONLY)
+		try:
+			while not self.done.is_set():
+				os.lseek(fd, 0, os.SEEK_SET)
+				self.add(time.time(), int(os.read(fd, 256).split()[1])*page, self.prof.current)
+				self.done.wait(self.interval)
+		finally:
+			os.close(fd)
+	def add(self, t, mem, region):
+		i = self.nsamp % len(self.samples)
+		self.times[i], self.samples[i] = t, mem
+		self.nsamp += 1
+		toks = region.split("/") if region else ["-"]
+		for j in range(len(toks)):
+			path = "/".join(toks[:j+1])
+			if path not in self.stats: self.stats[path] = [0, 0.0, 0]
+			s = self.stats[path]
+			s[0] += 1
+			s[1] += mem
+			s[2]  = s[2] if s[2] > mem else mem
+	# The samples still in the ring buffer, oldest first, as
+	# times, rss
+	def history(self):
+		n    = len(self.samples)
+		inds = np.arange(self.nsamp-n if self.nsamp > n else 0, self.nsamp) % n
+		return self.times[inds], self.samples[inds]
+	# Per-region report as a dict of name -> [nsamp, mean, peak]
+	def report(self):
+		return dict([(k, [n, tot/n, peak]) for k, (n, tot, peak) in self.stats.items()])
+	# Merge the reports of all tasks in comm. Returns a dict of name ->
+	# [nsamp, mean, peak, peak task], where nsamp is the total over the
+	# tasks, mean the sample-weighted mean, and peak the highest peak,
+	# which was reached on the given task. All tasks get the result.
+	def reduce(self, comm):
+		every = comm.allgather(self.report())
+		res   = {}
+		for k in set().union(*every):
+			rows = [(d[k], id) for id, d in enumerate(every) if k in d]
+			n    = sum([r[0] for r, id in rows])
+			mean = sum([r[0]*r[1] for r, id in rows])/n
+			peak, pid = sorted([(r[2], id) for r, id in rows])[-1]
+			res[k] = [n, mean, peak, pid]
+		return res
+	def to_str(self, report=None, fmt="%-32s %8d %10.4f %10.4f\n"):
+		report = report or self.report()
+		res = "%-32s %8s %10s %10s\n" % ("region", "nsamp", "mean GB", "peak GB")
+		for k in sorted(report):
+			v = report[k]
+			res += fmt % (k, v[0], v[1]/1024.**3, v[2]/1024.**3)
+		return res
+	def prt(self, report=None):
+		print self.to_str(report),
@@ -1,4 +1,4 @@
-import numpy as np, os, errno, h5py as h5
+import numpy as np, os, errno, h5py as h5, multiprocessing, multiprocessing.pool, contextlib, threading, collections, weakref, cPickle as pickle
 import pyfftw
 
 class Bunch(object):
@@ -32,46 +32,212 @@ def mkdir_safe(path):
 # point in a
 def recycle(a,b,p): return a + (b-a+p/2) % p - p/2
 
+# Thread pools are kept around, as they are expensive to set up
+# compared to a single call of the parallelized routines using
+# them. The threads of a pool don't survive a fork, so pools are
+# per process.
+pools = {}
+def get_pool(nthread=None):
+	if nthread == None:
+		nthread = int(os.environ.get("OMP_NUM_THREADS", multiprocessing.cpu_count()))
+	key = (os.getpid(), nthread)
+	if key not in pools:
+		pools[key] = multiprocessing.pool.ThreadPool(nthread)
+	return pools[key]
+
 #myfft = np.fft
 myfft = pyfftw.interfaces.numpy_fft
 pyfftw.interfaces.cache.enable()
 
+# Batched fft engine. Rather than looping over the rows of the
+# array in python, all rows are transformed in a single fftw
+# call along the last axis.
+#
+# Plans are made directly on the arrays being transformed and
+# discarded afterwards, so no references to them are kept, which
+# matters when every scan has a different length. Planning is
+# cached at the level of fftw wisdom instead, which can be saved
+# to disk and reloaded in later runs via save_wisdom/load_wisdom.
+# The default FFTW_ESTIMATE planning is cheap and doesn't touch
+# the arrays. With costlier flags like FFTW_MEASURE, plans are
+# only made on the real arrays when there is wisdom for them, as
+# measuring overwrites the arrays. Otherwise the measurement is
+# done once per layout on temporary scratch arrays, which are
+# freed again as soon as the wisdom has been gathered.
+#
+# If the real and complex arrays are the two views of an ffunion
+# buffer, the transform is done in place, without any temporaries.
+class FFTEngine:
+	def __init__(self, nthread=None, flags=("FFTW_ESTIMATE",)):
+		if nthread == None:
+			nthread = int(os.environ.get("OMP_NUM_THREADS", multiprocessing.cpu_count()))
+		self.nthread = nthread
+		self.flags   = tuple(flags)
+	# Make a plan for transforming a into b in the given direction
+	# ("FFTW_FORWARD" or "FFTW_BACKWARD").
+	def plan(self, a, b, direction):
+		flags = self.flags
+		if not (is_aligned(a) and is_aligned(b)): flags += ("FFTW_UNALIGNED",)
+		kwargs = dict(axes=(-1,), direction=direction, threads=self.nthread)
+		if "FFTW_ESTIMATE" in flags:
+			return pyfftw.FFTW(a, b, flags=flags, **kwargs)
+		try:
+			return pyfftw.FFTW(a, b, flags=flags+("FFTW_WISDOM_ONLY",), **kwargs)
+		except RuntimeError: pass
+		# No wisdom for this layout yet, so gather it using scratch arrays
+		if a.ctypes.data == b.ctypes.data:
+			tod, ft = ffunion(a.shape if direction == "FFTW_FORWARD" else b.shape,
+				dtype=real_dtype(ft_dtype(a)))
+			wa, wb = (tod, ft) if direction == "FFTW_FORWARD" else (ft, tod)
+		else:
+			wa = pyfftw.n_byte_align_empty(a.shape, pyfftw.simd_alignment, dtype=a.dtype)
+			wb = pyfftw.n_byte_align_empty(b.shape, pyfftw.simd_alignment, dtype=b.dtype)
+		pyfftw.FFTW(wa, wb, flags=flags, **kwargs)
+		del wa, wb
+		try:
+			return pyfftw.FFTW(a, b, flags=flags+("FFTW_WISDOM_ONLY",), **kwargs)
+		except RuntimeError:
+			return pyfftw.FFTW(a, b, flags=("FFTW_ESTIMATE",)+flags[-1:]*(flags[-1] == "FFTW_UNALIGNED"), **kwargs)
+	# Perform the actual transform of a into b, (1/n**0.5)-normalized.
+	# The normalization is applied in place, so nothing is allocated here.
+	def execute(self, a, b, direction, n):
+		self.plan(a, b, direction).execute()
+		b *= n**-0.5
+		return b
+	# Transform a into fa, which is allocated if not passed. Fa may
+	# be the fourier view of the ffunion buffer a is the real view of.
+	def rfft(self, a, fa=None):
+		n = a.shape[-1]
+		if fa is None or not can_transform(a, fa):
+			ca  = ft_dtype(a) if fa is None else fa.dtype
+			a   = np.ascontiguousarray(a, dtype=real_dtype(ca))
+			res = pyfftw.n_byte_align_empty(a.shape[:-1]+(n/2+1,), pyfftw.simd_alignment, dtype=ca)
+			self.execute(a, res, "FFTW_FORWARD", n)
+			if fa is None: return res
+			fa[...] = res
+			return fa
+		return self.execute(a, fa, "FFTW_FORWARD", n)
+	# Inverse of rfft. The output length is given either by n or
+	# by the shape of the output array a.
+	def irfft(self, fa, n=None, a=None):
+		if a is not None: n = a.shape[-1]
+		if a is None or not can_transform(fa, a):
+			fa  = np.ascontiguousarray(fa, dtype=ft_dtype(fa))
+			res = pyfftw.n_byte_align_empty(fa.shape[:-1]+(n,), pyfftw.simd_alignment,
+				dtype=real_dtype(fa.dtype) if a is None else a.dtype)
+			self.execute(fa, res, "FFTW_BACKWARD", n)
+			if a is None: return res
+			a[...] = res
+			return a
+		return self.execute(fa, a, "FFTW_BACKWARD", n)
+
+def is_aligned(a, n=pyfftw.simd_alignment):
+	return a.ctypes.data % n == 0
+
+def real_dtype(ctype):
+	return np.zeros(0,dtype=ctype).real.dtype
+
+def ft_dtype(a):
+	return np.result_type(a,0j)
+
+# Can a be transformed into b directly? This is the case if
+# they are compatible contiguous arrays, or the two views
+# of the same ffunion buffer.
+def can_transform(a, b):
+	if a.dtype.kind == "c": a, b = b, a
+	if b.dtype != ft_dtype(a) or a.shape[:-1] != b.shape[:-1]: return False
+	if a.ctypes.data == b.ctypes.data:
+		return b.flags["C_CONTIGUOUS"] and a.strides[:-1] == b.strides[:-1]
+	return a.flags["C_CONTIGUOUS"] and b.flags["C_CONTIGUOUS"]
+
+def save_wisdom(fname):
+	with open(fname, "wb") as f:
+		pickle.dump(pyfftw.export_wisdom(), f, -1)
+
+# Load wisdom saved by save_wisdom. A missing file
+# is not an error, as that just means that no wisdom
+# has been accumulated yet.
+def load_wisdom(fname):
+	try:
+		with open(fname, "rb") as f:
+			pyfftw.import_wisdom(pickle.load(f))
+	except IOError as exception:
+		if exception.errno != errno.ENOENT:
+			raise
+
+fft_engine = FFTEngine()
+
 # To keep fourier space units independent of the length
 # of the array, we will work with (1/n**0.5,1/n**0.5)-normalized
 # ffts. This differs from numpy, which uses (1,1/n) as the
 # normalization. The latter is good for convolutions and
 # decimation, but not for noise models.
-def rfft(a):
-	n = a.shape[-1]
-	b = a.reshape(np.prod(a.shape[:-1]),n)
-	fb = np.empty((b.shape[0],b.shape[1]/2+1),dtype=np.result_type(a,0j))
-	for i in range(b.shape[0]):
-		fb[i] = myfft.rfft(b[i])*n**-0.5
-	return np.reshape(fb, list(a.shape[:-1]) + [fb.shape[-1]])
-# Numpy irfft divides by 1/n, but we have already divided
-# by 1/n**0.5, so we need to compensate here
-def irfft(fa,n):
-	fb = fa.reshape(np.prod(fa.shape[:-1]),fa.shape[-1])
-	b  = np.empty((fb.shape[0],n))
-	for i in range(b.shape[0]):
-		b[i] = myfft.irfft(fb[i],n)*n**0.5
-	return np.reshape(b, list(fa.shape[:-1]) + [b.shape[-1]])
-
-def rfft_inplace(a, b):
-	for d in range(a.shape[0]):
-		b[d] = myfft.rfft(a[d])*a.shape[-1]**-0.5
-
-def irfft_inplace(a, b):
-	for d in range(a.shape[0]):
-		b[d] = myfft.irfft(a[d])*b.shape[-1]**0.5
+def rfft(a, engine=None):
+	return (engine or fft_engine).rfft(a)
+def irfft(fa, n, engine=None):
+	return (engine or fft_engine).irfft(fa, n)
+
+# Transform a into the preallocated b. When a and b are the
+# two views of an ffunion buffer, no memory is allocated, except
+# for the temporary scratch buffers used the first time a layout
+# is seen when the engine uses measuring flags like FFTW_MEASURE.
+def rfft_inplace(a, b, engine=None):
+	(engine or fft_engine).rfft(a, b)
+
+def irfft_inplace(a, b, engine=None):
+	(engine or fft_engine).irfft(a, a=b)
 
 def ffunion(shape, dtype=np.float64):
-	buf = pyfftw.n_byte_align_empty(list(shape[:-1])+[(shape[-1]/2+1)*2],16,dtype=dtype)
+	buf = pyfftw.n_byte_align_empty(list(shape[:-1])+[(shape[-1]/2+1)*2],pyfftw.simd_alignment,dtype=dtype)
 	#buf = np.empty(list(shape[:-1])+[(shape[-1]/2+1)*2],dtype=dtype)
 	tod = buf[...,:shape[-1]]
 	ft  = buf.view(dtype=np.result_type(dtype,0j))
 	return tod, ft
 
+# Pool of ffunion buffers, to avoid reallocating the same
+# workspaces over and over when processing many scans. Buffers
+# are handed out with get and returned with put, or via the
+# borrow context manager:
+#
+#  with pool.borrow(shape) as (tod, ft):
+#    ...
+#
+# Returned buffers are kept for reuse as long as the total
+# memory held by the pool stays below maxbytes, with the least
+# recently returned buffers being released first. The fft engine
+# doesn't keep references to the arrays it transforms, so buffers
+# released by the pool are really freed, also when every scan
+# has a different shape.
+class WorkPool:
+	def __init__(self, maxbytes=2**30):
+		self.maxbytes = maxbytes
+		self.nbytes   = 0
+		self.free     = []
+	def get(self, shape, dtype=np.float64):
+		key = (tuple(shape), np.dtype(dtype))
+		for i, (k, buf) in enumerate(self.free):
+			if k == key:
+				del self.free[i]
+				return buf
+		tod, ft = ffunion(shape, dtype)
+		self.nbytes += ft.nbytes
+		self.shrink(self.maxbytes)
+		return tod, ft
+	def put(self, buf):
+		tod, ft = buf
+		self.free.append(((tod.shape, tod.dtype), buf))
+		self.shrink(self.maxbytes)
+	# Release free buffers until at most nbytes are held
+	def shrink(self, nbytes=0):
+		while self.nbytes > nbytes and len(self.free) > 0:
+			k, (tod, ft) = self.free.pop(0)
+			self.nbytes -= ft.nbytes
+	@contextlib.contextmanager
+	def borrow(self, shape, dtype=np.float64):
+		buf = self.get(shape, dtype)
+		try: yield buf
+		finally: self.put(buf)
+
 def parse_slice(desc):
 	class Foo:
 		def __getitem__(self, p): return p
@@ -80,12 +246,106 @@ def parse_slice(desc):
 
 def h5dump(fname, data):
 	mkdir_safe(os.path.dirname(fname))
+	h5forget(fname)
 	with h5.File(fname,"w") as hfile:
 		hfile["data"] = data
 
-def h5get(fname, field):
-	with h5.File(fname,"r") as hfile:
-		return hfile[field]
+# Pool of hdf files opened for reading. Opening a file is
+# expensive compared to reading a small field from it, so files
+# are kept open and reused, with the least recently used one being
+# closed when more than maxopen are open, to bound the number of
+# file descriptors. Datasets from dataset() are live handles, but
+# die when their file is closed, so for references that must
+# outlive that, use view(), which reopens the file through the
+# pool whenever it is read from.
+#
+# A file that is open for reading can't be opened for writing by
+# the same process, so anything writing hdf files should first
+# call h5forget(fname), which closes it in every pool (h5dump and
+# the writers in mapio and ndinterpol do this). Files are also
+# reopened if their inode, size or modification time has changed
+# since they were opened, so that a file replaced by another
+# process (for example by writing a new one and renaming it over
+# the old) isn't read stale. Other processes can't write to the
+# file in place while it is open here, due to hdf file locking.
+class H5Pool:
+	def __init__(self, maxopen=64):
+		self.maxopen = maxopen
+		self.files   = collections.OrderedDict()
+		self.lock    = threading.RLock()
+		h5pools.add(self)
+	def open(self, fname):
+		fname = os.path.realpath(fname)
+		with self.lock:
+			stat = file_id(fname)
+			if fname in self.files:
+				hfile, fstat = self.files.pop(fname)
+				if fstat != stat:
+					hfile.close()
+					hfile = None
+			else: hfile = None
+			if hfile is None: hfile = h5.File(fname, "r")
+			self.files[fname] = (hfile, stat)
+			self.shrink(self.maxopen)
+			return hfile
+	# Close fname if it is open
+	def forget(self, fname):
+		fname = os.path.realpath(fname)
+		with self.lock:
+			if fname in self.files:
+				self.files.pop(fname)[0].close()
+	def dataset(self, fname, field):
+		return self.open(fname)[field]
+	def view(self, fname, field):
+		return H5View(self, fname, field)
+	# Read several fields from the same file in one go, returning
+	# a list of arrays. If sel is given, only data[sel] is read
+	# for each field.
+	def read(self, fname, fields, sel=Ellipsis):
+		with self.lock:
+			hfile = self.open(fname)
+			return [hfile[field][sel] for field in fields]
+	# Close files until at most n are open
+	def shrink(self, n=0):
+		with self.lock:
+			while len(self.files) > n:
+				fname, (hfile, stat) = self.files.popitem(last=False)
+				hfile.close()
+	def close(self): self.shrink(0)
+
+# A lazy reference to a field in an hdf file. Nothing is read until
+# it is sliced or converted to an array, at which point only the
+# selected part is read, via the pool.
+class H5View:
+	def __init__(self, pool, fname, field):
+		self.pool, self.fname, self.field = pool, fname, field
+		dset = pool.dataset(fname, field)
+		self.shape, self.dtype = dset.shape, dset.dtype
+	@property
+	def dataset(self): return self.pool.dataset(self.fname, self.field)
+	@property
+	def ndim(self): return len(self.shape)
+	def __len__(self): return self.shape[0]
+	def __getitem__(self, sel):
+		return self.pool.read(self.fname, [self.field], sel)[0]
+	def __array__(self, dtype=None):
+		return np.asarray(self[...], dtype=dtype)
+
+def file_id(fname):
+	stat = os.stat(fname)
+	return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime)
+
+h5pools = weakref.WeakSet()
+h5pool  = H5Pool()
+
+def h5forget(fname):
+	for pool in list(h5pools): pool.forget(fname)
+
+def h5get(fname, field, pool=None):
+	return (pool or h5pool).view(fname, field)
+
+def h5read(fname, fields, sel=Ellipsis, pool=None):
+	return (pool or h5pool).read(fname, fields, sel)
 
 reset   = "\033[0m"
 black   = "\033[0;30m"
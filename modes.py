@@ -3,12 +3,72 @@
 # m is the number of common modes to look for. For temperature
 # this would normally be 1, and for polarizaiton it would be
 # 3.
-import numpy as np
+import numpy as np, scipy.linalg
 from scipy.optimize import fmin_ncg, fmin_powell
 
-# This solution does not work for m > 1 due to a degeneracy between
-# the various modes.
+# The least squares solution for amps and mode is the best rank-m
+# approximation of d, which is given by the m strongest eigenvectors
+# of the detector covariance d d'. The solution is only unique up to
+# an invertible (m,m) transformation amps -> G amps, mode -> G'^-1 mode,
+# which we fix by requiring m columns of amps to be the identity matrix.
+# These reference detectors are picked by pivoted QR as the best
+# conditioned set, so dead or nearly dead detectors are never used.
+# For m = 1 this means that the detector with the largest amplitude
+# gets amplitude 1.
 def find_common_mode(d, m):
+	amps = amps_from_cov(d.dot(d.T), m)
+	mode = mode_from_amps(d, amps)
+	return mode, amps
+
+# Given the detector covariance cov = d d' (ndet,ndet),
+# return the least squares amplitudes (m,ndet).
+def amps_from_cov(cov, m):
+	n = cov.shape[0]
+	e, v = scipy.linalg.eigh(cov, eigvals=(n-m,n-1))
+	return fix_degeneracy(v.T)
+
+def fix_degeneracy(amps):
+	m = amps.shape[0]
+	q, r, piv = scipy.linalg.qr(amps, mode="economic", pivoting=True)
+	return np.linalg.solve(amps[:,piv[:m]], amps)
+
+# Streaming versions of the above, for tods that are too large to keep in
+# memory. The data is passed as source, which can either be a (ndet,nsamp)
+# array or hdf dataset, which is then read nchunk samples at a time, or a
+# function returning a new iterator over (ndet,nchunk) chunks (since the
+# data needs to be read twice). The first pass only accumulates the
+# (ndet,ndet) covariance, and the second one computes the mode chunk by chunk.
+def find_common_mode_streaming(source, m, nchunk=0x10000):
+	cov = 0
+	for chunk in iter_chunks(source, nchunk):
+		chunk = np.asarray(chunk, dtype=float)
+		cov  += chunk.dot(chunk.T)
+	return amps_from_cov(cov, m)
+
+# Yield the common mode (m,nchunk) given by amps for each chunk of source.
+# If subtract is True, the mode is also subtracted from the data. For
+# arrays and hdf datasets this is written back to source.
+def stream_common_mode(source, amps, nchunk=0x10000, subtract=False):
+	for sel, chunk in iter_chunks(source, nchunk, True):
+		chunk = np.asarray(chunk, dtype=float)
+		mode  = mode_from_amps(chunk, amps)
+		if subtract:
+			chunk -= amps.T.dot(mode)
+			if sel is not None: source[sel] = chunk
+		yield mode
+
+def iter_chunks(source, nchunk=0x10000, with_slice=False):
+	if callable(source):
+		for chunk in source():
+			yield (None, chunk) if with_slice else chunk
+	else:
+		for i in range(0, source.shape[1], nchunk):
+			sel = (slice(None),slice(i,i+nchunk))
+			yield (sel, source[sel]) if with_slice else source[sel]
+
+# This solution does not work for m > 1 due to a degeneracy between
+# the various modes. It is kept for reference.
+def find_common_mode_powell(d, m):
 	# Set up problem set. Assume 1 as starting value for parameters
 	info = Info(d, m)
 	# Set up a reasonable starting guess: All amplitudes are 1. Then
@@ -38,7 +98,7 @@ class Info:
 		self.mode = None
 		self.amps = None
 	def get_mode(self, amps):
-		if self.amps == None or np.any(amps != self.amps):
+		if self.amps is None or np.any(amps != self.amps):
 			self.amps = np.array(amps)
 			self.mode = mode_from_amps(self.d, amps)
 		return self.mode
@@ -1,29 +1,96 @@
-# This module defines parallel iteration over sequences.
-from mpi4py import MPI
+# This module defines parallel iteration over sequences, and
+# buffer-based collective operations on numpy arrays.
+#
+# mpi4py is optional. Without it, or when not started through
+# mpirun (a world of a single task), mine can instead run its
+# loops in a pool of local processes, if asked to.
+import numpy as np, heapq, os, sys, mmap, multiprocessing, traceback
+try:
+	from mpi4py import MPI
+	comm  = MPI.COMM_WORLD
+	myid  = comm.Get_rank()
+	nproc = comm.Get_size()
+except ImportError:
+	MPI, comm, myid, nproc = None, None, 0, 1
+world = comm
 
-comm  = MPI.COMM_WORLD
-myid  = comm.Get_rank()
-nproc = comm.Get_size()
+# Number of processes requested for the local backend, from
+# nlocal or $ENUTIL_NPROC, or None if it wasn't requested
+def local_nproc(nlocal=None):
+	if nlocal: return nlocal
+	if os.environ.get("ENUTIL_NPROC"): return int(os.environ["ENUTIL_NPROC"])
+	return None
 
 # Given a sequence which defines len and [], and an mpi
 # communicator, define an object which can be iterated over,
 # and which provides len, [] and has members specifying
-# the mapping between local and global indices
+# the mapping between local and global indices.
+#
+# By default the items are dealt out round-robin. If weights,
+# the relative cost of each item, are given, they are instead
+# assigned greedily in order of decreasing cost to the task
+# with the least total cost so far (longest processing time
+# first), which is deterministic, so every task arrives at the
+# same assignment without communicating.
+#
+# With dynamic=True, items are instead handed out one at a time
+# from a shared counter on task 0 (via one-sided mpi), so tasks
+# that finish early simply take more items. The items are handed
+# out in order of decreasing weight if weights are given. In this
+# mode the number of local items is not known in advance, so n
+# is None and only iteration is supported. Starting and finishing
+# an iteration are collective operations.
+#
+# The arrays in reduce are reduced with op ("sum", "prod", "max"
+# or "min") over all tasks when the iteration finishes, so that
+# they hold the total everywhere afterwards.
+#
+# If comm is not given and there is no mpi world with more than
+# one task, the loop runs serially in this process, as before.
+# The local backend is opt-in: if nlocal (or $ENUTIL_NPROC) is
+# set, that many local processes are forked when the iteration
+# starts instead, with myid 0 being the original process. The
+# others exit when they reach the end of their share or leave
+# the loop early, so only the original process continues after
+# the loop. Results must then be passed back through the reduce
+# arrays or arrays from shared_zeros, as anything else a forked
+# process computes is lost.
 class mine:
-	def __init__(self, seq, comm=comm):
+	def __init__(self, seq, comm=None, weights=None, dynamic=False, reduce=[], op="sum", nlocal=None):
+		nlocal = local_nproc(nlocal)
+		if comm is None and (nproc > 1 or not nlocal): comm = world
 		self.seq   = seq
 		self.comm  = comm
-		self.myid  = comm.Get_rank()
-		self.nproc = comm.Get_size()
+		self.myid  = comm.Get_rank() if comm else 0
+		self.nproc = comm.Get_size() if comm else nlocal or 1
 		self.N     = len(seq)
-		self.n     = (len(seq)-self.myid+self.nproc-1)/self.nproc
+		self.dynamic = dynamic
+		self.reduce  = reduce
+		self.op      = op
+		if weights is None:
+			self.order = np.arange(self.N)
+			self.owners = self.order % self.nproc
+		else:
+			self.order = np.argsort(-np.asarray(weights, dtype=float), kind="mergesort")
+			self.owners = lpt_owners(np.asarray(weights, dtype=float)[self.order], self.nproc)
+		self.assign(self.myid)
+	def assign(self, myid):
+		self.myid = myid
+		if self.dynamic:
+			self.inds = None
+			self.n    = None
+		else:
+			self.inds = np.sort(self.order[self.owners == myid])
+			self.n    = len(self.inds)
 	def __len__(self):
 		return self.n
 	def __getitem__(self, i):
+		return self.entry(i, self.inds[i])
+	def entry(self, i, I):
 		class Entry: pass
 		ind = Entry()
 		ind.i = i
-		ind.I = i*self.nproc+self.myid
+		ind.I = int(I)
 		ind.n = self.n
 		ind.N = self.N
 		ind.nproc = self.nproc
@@ -31,5 +98,242 @@ class mine:
 		ind.comm  = self.comm
 		return ind, self.seq[ind.I]
 	def __iter__(self):
-		for i in range(len(self)):
-			yield self[i]
+		if self.comm is not None:
+			counter = SharedCounter(self.comm) if self.dynamic else None
+			try:
+				for entry in self.entries(counter): yield entry
+			finally:
+				if counter: counter.free()
+			for a in self.reduce: allreduce(a, self.op, self.comm)
+		else:
+			for entry in self.iter_local(): yield entry
+	def entries(self, counter=None):
+		if not self.dynamic:
+			for i in range(len(self)):
+				yield self[i]
+		else:
+			i = 0
+			while True:
+				j = counter.next()
+				if j >= self.N: break
+				yield self.entry(i, self.order[j])
+				i += 1
+	# Local backend. Fork nproc-1 workers, each of which iterates
+	# over its share, stores its reduce arrays in shared memory and
+	# exits, while the original process handles share 0, waits for
+	# the others and combines the reduce arrays.
+	def iter_local(self):
+		counter = LocalCounter() if self.dynamic else None
+		bufs = [shared_zeros((self.nproc,)+a.shape, a.dtype) for a in self.reduce]
+		pids = []
+		for id in range(1, self.nproc):
+			pid = os.fork()
+			if pid == 0:
+				status = 1
+				try:
+					self.assign(id)
+					for entry in self.entries(counter): yield entry
+					for a, buf in zip(self.reduce, bufs): buf[id] = a
+					status = 0
+				except GeneratorExit:
+					sys.stderr.write("mine: local process %d left its loop early (break or exception)\n" % id)
+				except:
+					traceback.print_exc()
+				finally:
+					sys.stdout.flush(); sys.stderr.flush()
+					os._exit(status)
+			pids.append(pid)
+		failed = 0
+		try:
+			for entry in self.entries(counter): yield entry
+		finally:
+			for pid in pids:
+				failed += os.waitpid(pid, 0)[1] != 0
+		if failed: raise RuntimeError("%d of %d local processes failed" % (failed, self.nproc))
+		for a, buf in zip(self.reduce, bufs):
+			buf[0] = a
+			ufuncs[op_name(self.op)].reduce(buf, 0, out=a)
+
+# Assign items with the given costs, in the order given, to the
+# least loaded of nproc tasks. Returns the task of each item.
+def lpt_owners(costs, nproc):
+	owners = np.zeros(len(costs),dtype=int)
+	loads  = [(0.0, p) for p in range(nproc)]
+	for k, cost in enumerate(costs):
+		load, p = heapq.heappop(loads)
+		owners[k] = p
+		heapq.heappush(loads, (load+cost, p))
+	return owners
+
+# An integer counter living on task 0 of comm, which any task
+# can atomically fetch and increment without task 0 taking part.
+# Creating and freeing it are collective. With a single task
+# no window is needed (and some mpi implementations can't make
+# one without mpirun), so a plain integer is used.
+class SharedCounter:
+	def __init__(self, comm=comm, root=0):
+		self.root = root
+		self.buf  = np.zeros(1 if comm.Get_rank() == root else 0, dtype=np.int64)
+		self.win  = MPI.Win.Create(self.buf, self.buf.itemsize, comm=comm) if comm.Get_size() > 1 else None
+	def next(self):
+		if self.win is None:
+			self.buf[0] += 1
+			return int(self.buf[0]-1)
+		one, res = np.ones(1,dtype=np.int64), np.zeros(1,dtype=np.int64)
+		self.win.Lock(self.root)
+		self.win.Fetch_and_op(one, res, self.root, 0, MPI.SUM)
+		self.win.Unlock(self.root)
+		return int(res[0])
+	def free(self):
+		if self.win is not None: self.win.Free()
+
+# Counter shared by the processes of the local backend, which
+# inherit it when forked
+class LocalCounter:
+	def __init__(self):
+		self.val = multiprocessing.Value("l", 0)
+	def next(self):
+		with self.val.get_lock():
+			self.val.value += 1
+			return self.val.value-1
+
+# Allocate a zeroed array in anonymous shared memory, which is
+# shared with (rather than copied to) processes forked after it
+# was made, so the local backend of mine can write results to it.
+def shared_zeros(shape, dtype=np.float64):
+	dtype = np.dtype(dtype)
+	size  = int(np.prod(shape))
+	buf   = mmap.mmap(-1, max(size*dtype.itemsize,1))
+	return np.frombuffer(buf, dtype=dtype, count=size).reshape(shape)
+
+# Collective operations on numpy arrays. These use the buffer
+# interface of mpi4py rather than pickling, and work in place on
+# the array. MPI counts are 32-bit ints, so arrays are processed
+# in chunks of at most chunk_bytes bytes. Ops are given either by
+# name, as in ufuncs, or as an mpi op.
+chunk_bytes = 2**30
+ufuncs = {"sum": np.add, "prod": np.multiply, "max": np.maximum, "min": np.minimum}
+
+def mpi_op(op):
+	return getattr(MPI, op.upper()) if isinstance(op, basestring) else op
+
+def op_name(op):
+	if isinstance(op, basestring): return op
+	return [name for name in ufuncs if mpi_op(name) == op][0]
+
+# Return a flat, contiguous view of a, or a copy if a isn't
+# contiguous, together with a function copying the result back.
+def flat_work(a):
+	if a.flags.c_contiguous: return a.reshape(-1), lambda: None
+	work = np.ascontiguousarray(a).reshape(-1)
+	def finish(): a[...] = work.reshape(a.shape)
+	return work, finish
+
+def chunks(a):
+	n = max(1, chunk_bytes//a.itemsize)
+	return [a[i:i+n] for i in range(0, max(a.size,1), n)]
+
+# A pending nonblocking operation. wait() (or calling the handle)
+# waits for it to finish and returns its result, so a handle can
+# be used directly as the return value of the dots function of
+# cg.PipeCG.
+class Handle:
+	def __init__(self, reqs, result, finish=None):
+		self.reqs, self.result, self.finish = reqs, result, finish
+	def test(self):
+		return MPI.Request.Testall(self.reqs)
+	def wait(self):
+		MPI.Request.Waitall(self.reqs)
+		if self.finish: self.finish()
+		self.finish = None
+		return self.result
+	__call__ = wait
+
+def allreduce(a, op="sum", comm=comm):
+	work, finish = flat_work(a)
+	for c in chunks(work): comm.Allreduce(MPI.IN_PLACE, c, mpi_op(op))
+	finish()
+	return a
+
+def iallreduce(a, op="sum", comm=comm):
+	work, finish = flat_work(a)
+	reqs = [comm.Iallreduce(MPI.IN_PLACE, c, mpi_op(op)) for c in chunks(work)]
+	return Handle(reqs, a, finish)
+
+# Reduce a onto the root task, in place there. a is left
+# unchanged on the other tasks.
+def reduce(a, root=0, op="sum", comm=comm):
+	work, finish = flat_work(a)
+	for c in chunks(work):
+		if comm.Get_rank() == root: comm.Reduce(MPI.IN_PLACE, c, mpi_op(op), root)
+		else: comm.Reduce(c, None, mpi_op(op), root)
+	if comm.Get_rank() == root: finish()
+	return a
+
+def bcast(a, root=0, comm=comm):
+	work, finish = flat_work(a)
+	for c in chunks(work): comm.Bcast(c, root)
+	finish()
+	return a
+
+# Hierarchical allreduce for large arrays. The tasks on each node
+# first reduce their arrays into a shared memory window the size of
+# a single array, so the node only needs memory for one more array.
+# This is done in as many rounds as there are tasks on the node, with
+# each task accumulating its array into a different stripe of the
+# window each round. After this only one task per node takes part in
+# the global reduction. This cuts the network traffic by the number
+# of tasks per node. Only the ops in ufuncs are supported.
+node_comms = {}
+
+# Split comm into the tasks on the same node and the communicator
+# of the first task on each node (COMM_NULL for the others).
+def node_split(comm=comm):
+	key = comm.py2f()
+	if key not in node_comms:
+		node    = comm.Split_type(MPI.COMM_TYPE_SHARED, key=comm.Get_rank())
+		leaders = comm.Split(0 if node.Get_rank() == 0 else MPI.UNDEFINED, comm.Get_rank())
+		node_comms[key] = (node, leaders)
+	return node_comms[key]
+
+def allreduce_node(a, op="sum", comm=comm):
+	node, leaders = node_split(comm)
+	nn, r = node.Get_size(), node.Get_rank()
+	if nn == 1: return allreduce(a, op, leaders)
+	ufunc = ufuncs[op_name(op)]
+	work, finish = flat_work(a)
+	win = MPI.Win.Allocate_shared(work.nbytes if r == 0 else 0, work.itemsize, comm=node)
+	try:
+		buf, itemsize = win.Shared_query(0)
+		shared = np.frombuffer(buf, dtype=work.dtype, count=work.size)
+		win.Fence()
+		for k in range(nn):
+			s = (r+k)%nn
+			i1, i2 = work.size*s/nn, work.size*(s+1)/nn
+			if k == 0: shared[i1:i2] = work[i1:i2]
+			else: ufunc(shared[i1:i2], work[i1:i2], shared[i1:i2])
+			win.Fence()
+		if r == 0: allreduce(shared, op, leaders)
+		win.Fence()
+		work[...] = shared
+		win.Fence()
+	finally:
+		win.Free()
+	finish()
+	return a
+
+# Distributed versions of the dot products in cg, for vectors
+# that are split over the tasks of comm. dot is for CG and BCG,
+# idots is the nonblocking version of dots for PipeCG and coldot
+# is for BlockCG.
+def dot(a, b, comm=comm):
+	return allreduce(np.array([a.dot(b)]), comm=comm)[0]
+
+def dots(pairs, comm=comm):
+	return list(allreduce(np.array([a.dot(b) for a, b in pairs]), comm=comm))
+
+def idots(pairs, comm=comm):
+	return iallreduce(np.array([a.dot(b) for a, b in pairs]), comm=comm)
+
+def coldot(a, b, comm=comm):
+	return allreduce(np.sum(a*b, tuple(range(1,a.ndim))), comm=comm)
@@ -14,31 +14,208 @@
 #  x: (nsamp,idim), y: (nsamp,odim)
 # y and dy are logically N-dimensional grids, but variable dimensionality is
 # not practical to work with.
-import numpy as np, pyfinterpol
+#
+# Evaluation is done by the fortran pyfinterpol module if it has been
+# built, and otherwise by an equivalent vectorized numpy implementation.
+import numpy as np, os, errno, contextlib, h5py as h5
+from misc import h5forget, get_pool
+try:
+	import pyfinterpol
+except ImportError:
+	pyfinterpol = None
 
 class NdInterpol:
-	def __init__(self, box, n, vals):
+	def __init__(self, box, n, vals, dy=None):
 		self.box  = np.array(box,dtype=float)
 		self.n    = np.array(n)
-		self.y    = np.array(vals)
-		self.dy   = calc_gradients(self.y, self.n+1)
-	# Return interpolated values at every position in x.
-	def __call__(self, x):
-		return pyfinterpol.ipol(x.T, self.box.T, self.n+1, self.y.T, self.dy.T).T
+		self.y    = np.asarray(vals,dtype=float)
+		if dy is None: self.dy = calc_gradients(self.y, self.n+1)
+		else:          self.dy = np.asarray(dy,dtype=float)
+	# Return interpolated values at every position in x. The result
+	# is written to out if it is specified. The samples are split into
+	# chunks of at most chunk samples, which are evaluated in parallel
+	# using nthread threads. x and out can have any memory layout, but
+	# are only used without copying if they are C-contiguous.
+	def __call__(self, x, out=None, nthread=None, chunk=0x10000, backend=None):
+		kernel = ipol_fortran if use_fortran(backend) else ipol_numpy
+		n = np.array(self.n+1, dtype=np.int32)
+		return evaluate(kernel, (self.box, n, self.y, self.dy), x, out,
+				self.y.shape[1], nthread, chunk)
+
+# Locally adaptive version of NdInterpol. The box is split into
+# a regular grid of nt tiles, each of which has its own grid with
+# tn points, so that resolution is only spent where it is needed.
+# The grids of all the tiles are concatenated into y and dy, with
+# toff giving the offset of each tile's grid in these.
+#  self.y: (ngrid,odim), self.dy: (ngrid,odim,idim), self.box(2,idim),
+#  self.nt: (idim), self.tn: (ntile,idim), self.toff: (ntile)
+class TiledInterpol:
+	def __init__(self, box, nt, tn, toff, y, dy):
+		self.box  = np.array(box,dtype=float)
+		self.nt   = np.array(nt)
+		self.tn   = np.array(tn)
+		self.toff = np.array(toff)
+		self.y    = np.asarray(y,dtype=float)
+		self.dy   = np.asarray(dy,dtype=float)
+	# Same interface as NdInterpol.__call__
+	def __call__(self, x, out=None, nthread=None, chunk=0x10000, backend=None):
+		kernel = ipol_tiled_fortran if use_fortran(backend) else ipol_tiled_numpy
+		args = (self.box, np.array(self.nt,dtype=np.int32), np.array(self.tn,dtype=np.int32),
+				np.array(self.toff,dtype=np.int32), self.y, self.dy)
+		return evaluate(kernel, args, x, out, self.y.shape[1], nthread, chunk)
+
+def use_fortran(backend):
+	if backend is None: return pyfinterpol is not None
+	return backend == "fortran"
+
+# Evaluate kernel(x, out, *args) in parallel over chunks of x. With
+# nthread=1 the chunks are evaluated in the calling thread, so that
+# callers that are themselves parallel, like pmat, don't all end up
+# waiting for the same single-thread pool.
+def evaluate(kernel, args, x, out, odim, nthread=None, chunk=0x10000):
+	if out is None: out = np.empty((x.shape[0], odim))
+	def work(i):
+		kernel(x[i:i+chunk], out[i:i+chunk], *args)
+	starts = range(0, x.shape[0], chunk)
+	if len(starts) > 1 and nthread != 1:
+		get_pool(nthread).map(work, starts)
+	else:
+		for i in starts: work(i)
+	return out
+
+# The fortran routines want x and y transposed compared to us,
+# which is free as long as they are C-contiguous.
+def ipol_fortran(x, out, box, n, y, dy):
+	with fortran_out(out) as o:
+		pyfinterpol.ipol(x.T, box.T, n, y.T, dy.T, o.T)
+
+def ipol_tiled_fortran(x, out, box, nt, tn, toff, y, dy):
+	with fortran_out(out) as o:
+		pyfinterpol.ipol_tiled(x.T, box.T, nt, tn.T, toff, y.T, dy.T, o.T)
+
+@contextlib.contextmanager
+def fortran_out(out):
+	if out.flags["C_CONTIGUOUS"]:
+		yield out
+	else:
+		tmp = np.empty(out.shape)
+		yield tmp
+		out[...] = tmp
+
+# Vectorized numpy version of pyfinterpol.ipol. Here n is the number
+# of grid points (not cells) in each direction.
+def ipol_numpy(x, out, box, n, y, dy):
+	xrel  = (x-box[0])*((n-1)/(box[1]-box[0]))
+	xind  = np.floor(xrel+0.5).astype(int)
+	xrel -= xind
+	ig    = xind.dot(grid_steps(n))
+	out[...] = y[ig] + np.einsum("soi,si->so", dy[ig], xrel)
+
+# Vectorized numpy version of pyfinterpol.ipol_tiled
+def ipol_tiled_numpy(x, out, box, nt, tn, toff, y, dy):
+	tx    = (x-box[0])*(nt/(box[1]-box[0]))
+	tind  = np.clip(np.floor(tx).astype(int), 0, nt-1)
+	it    = tind.dot(grid_steps(nt))
+	n     = tn[it]
+	xrel  = (tx-tind)*(n-1)
+	xind  = np.floor(xrel+0.5).astype(int)
+	xrel -= xind
+	ig    = toff[it] + np.sum(xind*grid_steps(n),-1)
+	out[...] = y[ig] + np.einsum("soi,si->so", dy[ig], xrel)
+
+# Given the number of points n(...,idim) in each direction, return the
+# step in the flattened (C-ordered) grid corresponding to each direction
+def grid_steps(n):
+	n = np.asarray(n)
+	return np.concatenate([np.cumprod(n[...,:0:-1],-1)[...,::-1],
+		np.ones(n.shape[:-1]+(1,),dtype=n.dtype)],-1)
+
+# Interpolators can be stored either as hdf files or as a directory
+# of npy files (fmt "npy"), containing the arrays they are made up of.
+# When reading them back, the arrays are memory-mapped rather than read,
+# so many interpolators can be opened cheaply, with the data only being
+# read from disk when they are evaluated. Hdf datasets can only be
+# memory-mapped if they are contiguous and uncompressed, which is the
+# case for the files written here.
+interpol_types  = {"NdInterpol": NdInterpol, "TiledInterpol": TiledInterpol}
+interpol_fields = {"NdInterpol": ["box","n","y","dy"],
+		"TiledInterpol": ["box","nt","tn","toff","y","dy"]}
+
+def write_interpol(fname, ip, fmt=None):
+	fmt  = interpol_fmt(fname, fmt)
+	kind = ip.__class__.__name__
+	if fmt == "hdf":
+		h5forget(fname)
+		with h5.File(fname,"w") as hfile:
+			hfile.attrs["type"] = kind
+			for field in interpol_fields[kind]:
+				hfile[field] = getattr(ip, field)
+	elif fmt == "npy":
+		try:
+			os.makedirs(fname)
+		except OSError as exception:
+			if exception.errno != errno.EEXIST:
+				raise
+		with open(os.path.join(fname,"type"),"w") as f:
+			f.write(kind + "\n")
+		for field in interpol_fields[kind]:
+			np.save(os.path.join(fname, field + ".npy"), getattr(ip, field))
+	else:
+		raise ValueError
+
+def read_interpol(fname, fmt=None):
+	fmt = interpol_fmt(fname, fmt)
+	if fmt == "hdf":
+		with h5.File(fname,"r") as hfile:
+			kind = str(hfile.attrs["type"])
+			data = [h5mmap(fname, hfile[field]) for field in interpol_fields[kind]]
+	elif fmt == "npy":
+		with open(os.path.join(fname,"type"),"r") as f:
+			kind = f.read().strip()
+		data = [np.load(os.path.join(fname, field + ".npy"), mmap_mode="r") for field in interpol_fields[kind]]
+	else:
+		raise ValueError
+	return interpol_types[kind](*data)
+
+def interpol_fmt(fname, fmt=None):
+	if fmt == None:
+		if fname[-4:] == ".hdf": fmt = "hdf"
+		else: fmt = "npy"
+	return fmt
+
+# Memory-map the given hdf dataset if possible, and read it otherwise
+def h5mmap(fname, dset):
+	offset = dset.id.get_offset()
+	if dset.chunks is None and dset.compression is None and offset is not None:
+		return np.memmap(fname, mode="r", dtype=dset.dtype, shape=dset.shape, offset=offset)
+	return dset[...]
 
 # Builds an interpolation to required precision.
-# This implementation is somewhat wasteful, in
-# that it evaluates some items more often than required.
-# The alternative would, however, be significantly less
-# clear.
-def build_interpol(box, func, maxerr):
+# Function evaluations are memoized through a GridCache,
+# so func is only called for grid points that have not
+# been evaluated before, in one batch per trial grid.
+#
+# The refinement checks the error half a cell away from the
+# grid points along one axis at a time, which misses the cross
+# terms between the axes. So once it converges, the error is
+# also checked at the cell centers, which are the points furthest
+# from the grid, and the axis whose refinement reduces that the
+# most is refined until it is good enough too.
+#
+# func is assumed to be valid within bounds (by default the box
+# itself). Where the edges of the box are inside bounds, the
+# gradients there are computed from function values on both
+# sides rather than one-sided.
+def build_interpol(box, func, maxerr, bounds=None):
 	box        = np.array(box,dtype=float)
 	idim       = box.shape[1]
 	n          = np.array([3]*idim)
-	xgrid      = makegrid(box[0], box[1], n)
+	cache      = GridCache(box, func)
+	if bounds is None: bounds = box
+	def make(n, y): return NdInterpol(box, n, y, calc_gradients_within(box, n, y, func, bounds))
 
 	# Set up initial interpolation
-	ip = NdInterpol(box, n, func(xgrid))
+	ip = make(n, cache(n))
 
 	# Refine until good enough
 	errs = [None]*idim
@@ -46,25 +223,112 @@ def build_interpol(box, func, maxerr):
 		nok = 0
 		# Consider accuracy for each input parameter
 		for i in range(idim):
-			if errs[i] == None or any(errs[i] > maxerr):
+			if errs[i] is None or any(errs[i] > maxerr):
 				# Grid may not be good enough in this direction.
 				# Try doubling resolution
 				nnew = np.array(ip.n); nnew[i] *= 2
 				xnew = makegrid(box[0], box[1], nnew)
 				yinter = ip(xnew)
-				ytrue  = func(xnew)
+				ytrue  = cache(nnew)
 				diff = ytrue-yinter
 				ind  = np.argmax(diff,0)
 				err = np.amax(abs(ytrue-yinter), 0)
 				if any(err > maxerr):
 					# Not good enough, so accept improvement
-					ip = NdInterpol(box, nnew, ytrue)
+					ip = make(nnew, ytrue)
 				else: nok += 1
 				errs[i] = err
 			else: nok += 1
-		if nok >= idim: break
+		if nok < idim: continue
+		if center_error(ip, func) <= maxerr: break
+		cands = []
+		for i in range(idim):
+			nnew = np.array(ip.n); nnew[i] *= 2
+			cand = make(nnew, cache(nnew))
+			cands.append((center_error(cand, func), i, cand))
+		ip = min(cands)[2]
 	return ip
 
+# The maximum interpolation error of ip at the centers of its cells
+def center_error(ip, func):
+	h = (ip.box[1]-ip.box[0])/ip.n
+	x = makegrid(ip.box[0]+h/2, ip.box[1]-h/2, ip.n-1)
+	return np.max(abs(np.asarray(func(x))-ip(x)))
+
+# Builds a TiledInterpol with nt tiles in each direction, each
+# refined independently to the required precision. This avoids
+# increasing the resolution everywhere due to a small problematic
+# region, such as near a pole. The tiles are built with box as
+# their bounds, so their gradients are continuous across the tile
+# edges, and they are as accurate there as elsewhere.
+def build_tiled_interpol(box, func, maxerr, nt):
+	box   = np.array(box,dtype=float)
+	nt    = np.array(nt)*np.ones(box.shape[1],dtype=int)
+	tsize = (box[1]-box[0])/nt
+	tiles = []
+	tinds = np.rollaxis(np.indices(nt),0,len(nt)+1).reshape(-1,len(nt))
+	for tind in tinds:
+		t0 = box[0]+tind*tsize
+		tiles.append(build_interpol([t0,t0+tsize], func, maxerr, bounds=box))
+	tn   = np.array([tile.n+1 for tile in tiles])
+	toff = np.concatenate([[0],np.cumsum(np.prod(tn,1))[:-1]])
+	return TiledInterpol(box, nt, tn, toff,
+		np.concatenate([tile.y for tile in tiles]),
+		np.concatenate([tile.dy for tile in tiles]))
+
+# Cache of function evaluations on the grids tried by build_interpol.
+# The number of cells along each axis only ever doubles there, so
+# the points of two grids coincide on regular sub-lattices, where
+# grid index j in a grid with n cells corresponds to index j*m/n in
+# one with m cells. The cache keeps the values of the evaluated grids
+# as full nD arrays, and fills in the points of a new grid using
+# strided slices of these, only calling func for the rest. Grids that
+# are entirely contained in a later one are discarded.
+class GridCache:
+	def __init__(self, box, func):
+		self.box   = np.array(box,dtype=float)
+		self.func  = func
+		self.grids = []
+		self.neval = 0
+	# Return the function values on the grid with n cells in
+	# each direction, in the same (ngrid,odim) layout as makegrid.
+	def __call__(self, n):
+		n     = np.array(n)
+		known = np.zeros(n+1,dtype=bool)
+		vals  = None
+		for nc, vc in self.grids:
+			sel = grid_overlap(n, nc)
+			if sel is None: continue
+			if vals is None: vals = np.empty(tuple(n+1)+vc.shape[-1:])
+			vals[sel[0]]  = vc[sel[1]]
+			known[sel[0]] = True
+		missing = ~known.reshape(-1)
+		if np.any(missing):
+			x    = makegrid(self.box[0], self.box[1], n)[missing]
+			ynew = np.asarray(self.func(x))
+			self.neval += len(x)
+			if vals is None: vals = np.empty(tuple(n+1)+ynew.shape[-1:])
+			vals.reshape(-1,vals.shape[-1])[missing] = ynew
+			self.grids = [g for g in self.grids if not is_subgrid(g[0], n)] + [(n, vals)]
+		return vals.reshape(-1,vals.shape[-1])
+
+# Given the cell counts n and nc of two nested grids, return the
+# slices selecting their common points in each of them, or None if
+# their resolutions are not related by integer factors.
+def grid_overlap(n, nc):
+	dst, src = [], []
+	for a, b in zip(n, nc):
+		if a >= b and a % b == 0:
+			dst.append(slice(None,None,a/b)); src.append(slice(None))
+		elif b > a and b % a == 0:
+			dst.append(slice(None)); src.append(slice(None,None,b/a))
+		else: return None
+	return tuple(dst), tuple(src)
+
+# Is every point of the grid with nc cells also a point in the one with n?
+def is_subgrid(nc, n):
+	return np.all(n % nc == 0)
+
 # Return an (ngrid(n+1),idim) array of evenly spaced points
 # within the rectangle specified by x0:x1. The mapping from
 # the implicit N-dimensional space to the actually used 1-d
@@ -86,3 +350,30 @@ def calc_gradients(y, n):
 	grads = np.array([np.reshape(np.gradient(nd_y[...,i]),(idim,np.prod(n))) for i in range(odim)])
 	# Result is now (odim,idim,ngrid), so move ngrid to 0
 	return np.ascontiguousarray(np.rollaxis(grads,2))
+
+# Like calc_gradients, for the values y of func on the grid with n
+# cells covering box. Where an edge of box is more than half a cell
+# inside bounds, func is evaluated on an extra layer of points just
+# outside that edge, so that the gradients there are central
+# differences like in the rest of the grid rather than one-sided.
+def calc_gradients_within(box, n, y, func, bounds):
+	idim, odim = len(n), y.shape[-1]
+	h     = (box[1]-box[0])/n
+	lo    = (box[0]-bounds[0] > h/2).astype(int)
+	hi    = (bounds[1]-box[1] > h/2).astype(int)
+	if not np.any(lo) and not np.any(hi): return calc_gradients(y, n+1)
+	x     = makegrid(box[0], box[1], n).reshape(tuple(n+1)+(idim,))
+	inner = tuple([slice(l,l+m+1) for l, m in zip(lo,n)])
+	nd_y  = np.zeros(tuple(n+1+lo+hi)+(odim,))
+	nd_y[inner] = y.reshape(tuple(n+1)+(odim,))
+	for d in range(idim):
+		for side, ind, off in [(lo[d],0,-h[d]),(hi[d],-1,h[d])]:
+			if not side: continue
+			xface = np.take(x, [ind], d).copy()
+			xface[...,d] += off
+			sel    = list(inner); sel[d] = slice(ind,ind+1 if ind >= 0 else None)
+			nd_y[tuple(sel)] = np.asarray(func(xface.reshape(-1,idim))).reshape(xface.shape[:-1]+(odim,))
+	grads = np.array([np.reshape(np.gradient(nd_y[...,i]),(idim,)+nd_y.shape[:-1]) for i in range(odim)])
+	grads = grads[(slice(None),slice(None))+inner]
+	# Result is now (odim,idim,...), so move the grid to the front
+	return np.ascontiguousarray(np.rollaxis(grads.reshape(odim,idim,-1),2))
@@ -0,0 +1,102 @@
+# This module implements the pointing matrix P used in map-making,
+# based on the interpolated pointing from ndinterpol, as described at
+# the end of point.py. The interpolator turns the pointing of each
+# detector in the input coordinates (boresight + detector offset)
+# into [ra,pi/2-dec,cos2psi,sin2psi], which is then turned into a
+# pixel in a flat (ncomp,ndec,nra) map and the TQU response
+#  T + cos(2(psi+dpsi)) Q + sin(2(psi+dpsi)) U,
+# where dpsi is the detector polarization angle. The rotation by dpsi
+# is done via precomputed cos(2dpsi) and sin(2dpsi), so no trigonometric
+# functions are evaluated per sample.
+#
+# The full pointing is never stored. With the fortran pypmat module and
+# an NdInterpol, interpolation, pixelization and projection are done in
+# a single pass over the samples. Otherwise the pointing is computed one
+# detector at a time in numpy. Detectors are processed in parallel, with
+# each thread accumulating into its own map in the transpose operation.
+import numpy as np, os, multiprocessing
+from ndinterpol import NdInterpol
+from misc import get_pool
+try:
+	import pypmat
+except ImportError:
+	pypmat = None
+
+class PmatInterpol:
+	def __init__(self, ip, bore, offsets, polangle, shape, box, noise=None, nthread=None, backend=None):
+		"""Set up a pointing matrix for the tod (ndet,nsamp) given by the boresight
+		pointing bore (nsamp,idim) and detector offsets (ndet,idim) in the input
+		coordinates of the interpolator ip, and detector polarization angles
+		polangle (ndet). Maps have the given shape (ncomp,ndec,nra), with ncomp
+		either 1 (T) or 3 (TQU), and box [[ra1,dec1],[ra2,dec2]] like in mapio.
+		noise is an optional function applying the inverse noise matrix to a
+		tod in place, used in the A = P'N^-1P operator implemented by __call__."""
+		self.ip       = ip
+		self.bore     = np.ascontiguousarray(bore, dtype=float)
+		self.offsets  = np.ascontiguousarray(offsets, dtype=float)
+		self.polcs    = np.ascontiguousarray(np.array([np.cos(2*polangle),np.sin(2*polangle)]).T)
+		self.shape    = tuple(shape)
+		self.box      = np.array(box,dtype=float)
+		self.noise    = noise
+		self.nthread  = nthread or int(os.environ.get("OMP_NUM_THREADS", multiprocessing.cpu_count()))
+		self.ndet     = self.offsets.shape[0]
+		self.nsamp    = self.bore.shape[0]
+		if backend is None:
+			backend = "fortran" if pypmat and isinstance(ip, NdInterpol) else "numpy"
+		self.backend  = backend
+	def forward(self, m, tod=None):
+		"""Project the map m into the tod, overwriting it. Returns the tod."""
+		if tod is None: tod = np.empty((self.ndet, self.nsamp))
+		m = np.ascontiguousarray(m, dtype=float)
+		self.run(lambda d0, d1: self.kernel(1, m, tod, d0, d1))
+		return tod
+	def transpose(self, tod, m=None):
+		"""Accumulate the tod into the map m, which is zero-initialized if
+		not specified. Returns the map."""
+		if m is None: m = np.zeros(self.shape)
+		tod  = np.ascontiguousarray(tod, dtype=float)
+		maps = [m] + [np.zeros(self.shape) for i in range(min(self.nthread,self.ndet)-1)]
+		self.run(lambda d0, d1, m: self.kernel(-1, m, tod, d0, d1), maps)
+		for other in maps[1:]: m += other
+		return m
+	def __call__(self, x):
+		"""Apply A = P'N^-1P to the flattened map x, so that this object
+		can be used as the A argument of cg.CG."""
+		tod = self.forward(x.reshape(self.shape))
+		if self.noise: self.noise(tod)
+		return self.transpose(tod).reshape(-1)
+	# Split the detectors into one block per thread, and call
+	# fun(d0,d1,*extra) for each of them in parallel, where
+	# extra is the corresponding entry in each of args.
+	def run(self, fun, *args):
+		nblock = min(self.nthread, self.ndet)
+		edges  = [self.ndet*i/nblock for i in range(nblock+1)]
+		def work(i): fun(edges[i], edges[i+1], *[arg[i] for arg in args])
+		if nblock > 1: get_pool(nblock).map(work, range(nblock))
+		else: work(0)
+	def kernel(self, dir, m, tod, d0, d1):
+		if self.backend == "fortran":
+			ip = self.ip
+			pypmat.pmat_tqu(dir, self.bore.T, self.offsets[d0:d1].T, self.polcs[d0:d1].T,
+					ip.box.T, np.array(ip.n+1,dtype=np.int32), ip.y.T, ip.dy.T, self.box.T,
+					tod[d0:d1].T, m.T)
+		else:
+			for d in range(d0, d1):
+				self.kernel_numpy(dir, m, tod[d], d)
+	# Numpy version of pypmat.pmat_tqu for a single detector
+	def kernel_numpy(self, dir, m, tod, d):
+		p   = self.ip(self.bore+self.offsets[d], nthread=1)
+		n   = np.array(self.shape[-1:-3:-1])
+		pix = np.round((np.array([p[:,0],np.pi/2-p[:,1]]).T-self.box[0])*((n-1)/(self.box[1]-self.box[0]))).astype(int)
+		ok  = np.all((pix >= 0) & (pix < n),1)
+		pix = pix[ok].dot([1,n[0]])
+		c2  = p[ok,2]*self.polcs[d,0] - p[ok,3]*self.polcs[d,1]
+		s2  = p[ok,3]*self.polcs[d,0] + p[ok,2]*self.polcs[d,1]
+		weights = [np.ones(len(pix)), c2, s2][:self.shape[0]]
+		flat = m.reshape(self.shape[0],-1)
+		if dir > 0:
+			tod[...] = 0
+			tod[ok] = np.sum([w*comp[pix] for w, comp in zip(weights, flat)],0)
+		else:
+			for w, comp in zip(weights, flat):
+				comp += np.bincount(pix, w*tod[ok], minlength=comp.size)
@@ -1,5 +1,6 @@
 from pyslalib.slalib import *
 import iers, pyfsla, math, numpy as np
+from misc import get_pool
 
 arcsec = np.pi/180/60/60
 
@@ -23,75 +24,151 @@ def astro2std(point, sys):
 std2astro = astro2std
 
 # Transform from apparent horizontal to equatorial (celestial) mean coordinates.
+# The star-independent apparent-to-mean parameters change slowly, so rather
+# than being computed per sample, they are computed once per chunk of dt
+# seconds, for the middle of the chunk, and reused for all samples in it.
+# Chunks are processed in parallel using nthread threads. If dt is None,
+# a single set of parameters is used for the whole array.
 class hor2equ:
-	def __init__(self, site):
-		self.site = site
+	def __init__(self, site, dt=10.0, nthread=None):
+		self.site    = site
+		self.dt      = dt
+		self.nthread = nthread
 	def __call__(self, icoord):
 		tcoord = np.array(icoord)
-		mjd0 = icoord[0,0]
+		mjd    = icoord[:,0]
+		if self.dt is None: bins = np.zeros(len(mjd),dtype=int)
+		else: bins = np.floor((mjd-mjd[0])*86400/self.dt).astype(int)
+		edges  = np.concatenate([[0],np.flatnonzero(np.diff(bins))+1,[len(mjd)]])
+		def work(i):
+			i1, i2 = edges[i], edges[i+1]
+			ao, am = self.params(0.5*(mjd[i1]+mjd[i2-1]))
+			tcoord[i1:i2,1:] = pyfsla.aomulti(mjd[i1:i2], icoord[i1:i2,1:].T, ao, am).T
+		nchunk = len(edges)-1
+		if nchunk > 1: get_pool(self.nthread).map(work, range(nchunk))
+		else: map(work, range(nchunk))
+		return tcoord
+	# Compute the star-independent parameters for the given time
+	def params(self, mjd0):
 		info   = iers.lookup(mjd0)
 		as2rad = math.pi/180/60/60
 		ao = sla_aoppa(mjd0, info.dUT, self.site.lon, self.site.lat, self.site.alt,
 			info.pmx*as2rad, info.pmy*as2rad, self.site.T, self.site.P, self.site.hum,
 			299792.458/self.site.freq, 0.0065)
 		am = sla_mappa(2000.0, mjd0)
-		tcoord[:,1:] = pyfsla.aomulti(icoord[:,0], icoord[:,1:].T, ao, am).T
-		return tcoord
+		return ao, am
 
-class equ2gal:
+# Fixed rotation of the coordinates, given by the 3x3 matrix R acting on
+# the unit vectors corresponding to each coordinate pair. This is much
+# cheaper than calling slalib per sample, and consecutive rotmatrix stages
+# of a rotchain are combined into a single matrix.
+class rotmatrix:
+	def __init__(self, R):
+		self.R = np.array(R,dtype=float)
 	def __call__(self, icoord):
 		tcoord = np.array(icoord)
-		tcoord[:,1:] = pyfsla.equ2gal(icoord[:,1:].T).T
+		tcoord[:,1:] = vec2ang(ang2vec(icoord[:,1:]).dot(self.R.T))
 		return tcoord
+	def track(self, t, v, e, step=None):
+		return v.dot(self.R.T), e.dot(self.R.T)
+
+# J2000 equatorial to galactic, using the same matrix as sla_eqgal
+class equ2gal(rotmatrix):
+	def __init__(self):
+		rotmatrix.__init__(self, [
+			[-0.054875539726,-0.873437108010,-0.483834985808],
+			[+0.494109453312,-0.444829589425,+0.746982251810],
+			[-0.867666135858,-0.198076386122,+0.455983795705]])
+
+# Rotation by the zyz euler angles a, b and c, which can be used to
+# for example move from a detector's coordinate system to the boresight's.
+def euler(a, b, c):
+	return rotmatrix(rotz(a).dot(roty(b)).dot(rotz(c)))
+def rotz(a):
+	c, s = np.cos(a), np.sin(a)
+	return np.array([[c,-s,0],[s,c,0],[0,0,1]])
+def roty(a):
+	c, s = np.cos(a), np.sin(a)
+	return np.array([[c,0,s],[0,1,0],[-s,0,c]])
 
+# Convert between (nsamp,[phi,theta]) and (nsamp,[x,y,z])
+def ang2vec(a):
+	st = np.sin(a[:,1])
+	return np.array([st*np.cos(a[:,0]),st*np.sin(a[:,0]),np.cos(a[:,1])]).T
+def vec2ang(v):
+	return np.array([np.arctan2(v[:,1],v[:,0]) % (2*np.pi),
+		np.arctan2((v[:,0]**2+v[:,1]**2)**0.5,v[:,2])]).T
+
+# Apply a series of rotations. Consecutive fixed rotations are combined
+# into a single matrix, so that only one pass over the coordinates is
+# needed for them.
 class rotchain:
 	def __init__(self, rots):
-		self.rots = rots
+		self.rots = []
+		for rot in rots:
+			if isinstance(rot, rotmatrix) and len(self.rots) > 0 and isinstance(self.rots[-1], rotmatrix):
+				self.rots[-1] = rotmatrix(rot.R.dot(self.rots[-1].R))
+			else:
+				self.rots.append(rot)
 	def __call__(self, icoord):
-		out = np.array(icoord)
+		out = icoord
 		for rot in self.rots:
 			out = rot(out)
-		return out
+		return np.array(out)
+	def track(self, t, v, e, step=arcsec):
+		for rot in self.rots:
+			v, e = track(rot, t, v, e, step)
+		return v, e
 
 # This function performs rotation "rotation" on on coordinates icoord,
-# but also computes the psi of the rotation this
-# induces in the local coordinate system. This is done by duplicating
-# every point into two closely offset points, transforming both, and
-# measuring their relative orientation after the transformation.
-# This is general (i.e. it will work independently of which underlying
-# pointing library is used), but is a bit inefficient, and may suffer from
-# numerical instability if the points are chosen to be too close.
+# but also computes the psi of the rotation this induces in the local
+# coordinate system. This is done by propagating the local north direction
+# of each point through the rotation as a tangent vector together with the
+# point itself (see track), and measuring its orientation relative to the
+# local north after the rotation. psi is positive when the rotated north
+# points towards lower phi. If cos2psi is True, [cos(2psi),sin(2psi)] are
+# returned instead of psi, which avoids any trigonometric evaluations.
 class rot_polang:
-	def __init__(self, rot, step=arcsec):
+	def __init__(self, rot, step=arcsec, cos2psi=False):
 		self.rot  = rot
 		self.step = step
+		self.cos2psi = cos2psi
 	def __call__(self, icoord):
-		icoord2 = np.array(icoord)
-		icoord2[:,2] = icoord[:,2] - self.step
-		# Handle pole-crossing
-		inds = np.where(icoord2[:,2] < 0)
-		icoord2[inds,2] = -icoord2[inds,2]
-		icoord2[inds,1] = icoord2[inds,1]+np.pi
-		# Transform both sets of coordinates
-		ocoord  = self.rot(icoord)
-		ocoord2 = self.rot(icoord2)
-		# Make sure we don't have a 2pi skip between ocoord and ocoord2
-		ocoord2 = ocoord + (ocoord2-ocoord+np.pi) % (2*np.pi) - np.pi
-		# Get distance between pairs of points by haversine. These
-		# should be very close to step.
-		dists = haverdist(ocoord[:,1:],ocoord2[:,1:])
-		# Calculate psi by the haversine formula
-		hC  = (haversin(ocoord2[:,2])-haversin(ocoord[:,2]-dists))/(np.sin(ocoord[:,2])*np.sin(dists))
-		# Numerical issues with very small angles may make hC negative:
-		hC = np.maximum(0, hC)
-		psi = 2*np.arcsin(hC**0.5)
-		# Differentiate between left and right rotation:
-		inds = np.where(ocoord2[:,1]>ocoord[:,1])
-		psi[inds] = -psi[inds]
-		res = np.zeros((icoord.shape[0],4))
-		res[:,:3] = ocoord
-		res[:,3]  = psi
-		return res
+		v, e  = track(self.rot, icoord[:,0], ang2vec(icoord[:,1:]), -theta_vec(icoord[:,1:]), self.step)
+		ocoord = np.empty((icoord.shape[0],3))
+		ocoord[:,0]  = icoord[:,0]
+		ocoord[:,1:] = vec2ang(v)
+		c =  np.sum(e*-theta_vec(ocoord[:,1:]),1)
+		s = -np.sum(e*phi_vec(ocoord[:,1:]),1)
+		if self.cos2psi:
+			n2 = c**2+s**2
+			return np.hstack([ocoord, np.array([(c**2-s**2)/n2, 2*c*s/n2]).T])
+		return np.hstack([ocoord, np.arctan2(s,c)[:,None]])
+
+# Apply the rotation rot to the unit vectors v (nsamp,3) at times t,
+# along with the tangent vectors e at the same points, returning the
+# transformed (v,e). Rotations that know how to do this themselves
+# (such as rotmatrix and rotchain) provide a track method. Otherwise
+# a point offset by step along e is transformed too, and the new
+# tangent vector is computed from the pair. This works in cartesian
+# coordinates, so no special handling of the poles is needed.
+def track(rot, t, v, e, step=arcsec):
+	if hasattr(rot, "track"): return rot.track(t, v, e, step)
+	v2 = v + step*e
+	v2 /= np.sum(v2**2,1)[:,None]**0.5
+	v  = ang2vec(rot(np.hstack([t[:,None],vec2ang(v)]))[:,1:])
+	v2 = ang2vec(rot(np.hstack([t[:,None],vec2ang(v2)]))[:,1:])
+	e  = v2-v
+	e -= v*np.sum(e*v,1)[:,None]
+	e /= np.sum(e**2,1)[:,None]**0.5
+	return v, e
+
+# Local unit vectors in the direction of increasing theta and phi
+def theta_vec(a):
+	ct, st = np.cos(a[:,1]), np.sin(a[:,1])
+	return np.array([ct*np.cos(a[:,0]),ct*np.sin(a[:,0]),-st]).T
+def phi_vec(a):
+	return np.array([-np.sin(a[:,0]),np.cos(a[:,0]),np.zeros(len(a))]).T
 
 def haversin(theta): return np.sin(theta/2)**2
 def haverdist(c1, c2):
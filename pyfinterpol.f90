@@ -10,17 +10,21 @@
 ! When collapsing dimensions, use C ordering, as it has no
 ! impact on performance in this case.
 
-function ipol(x, xbox, n, ygrid, dygrid) result(y)
+subroutine ipol(x, xbox, n, ygrid, dygrid, y, incomp, oncomp, nsamp, ngrid)
   implicit none
-  real*8       :: x(:,:), xbox(:,:), ygrid(:,:), dygrid(:,:,:)
-  real*8       :: y(size(ygrid,1),size(x,2))
-  real*8       :: x0(size(x,1)), idx(size(x,1))
-  real*8       :: xrel(size(x,1))
-  integer*4    :: n(:), xind(size(x,1))
-  integer*4    :: incomp, oncomp, nsamp, ngrid, ic, oc, is, ig
-  integer*4    :: steps(size(x,1))
-  incomp = size(x,1); oncomp = size(ygrid,1)
-  nsamp  = size(x,2); ngrid  = size(ygrid,2)
+  ! The output is passed in rather than returned so that the caller
+  ! can evaluate into a preallocated buffer, and the gil is released
+  ! so that several chunks of samples can be evaluated in parallel.
+  ! Explicit shapes are used, as f2py does not support threadsafe
+  ! for assumed-shape arguments.
+  !f2py intent(inout) y
+  !f2py threadsafe
+  integer*4    :: incomp, oncomp, nsamp, ngrid
+  real*8       :: x(incomp,nsamp), xbox(incomp,2), ygrid(oncomp,ngrid)
+  real*8       :: dygrid(incomp,oncomp,ngrid), y(oncomp,nsamp)
+  real*8       :: x0(incomp), idx(incomp), xrel(incomp)
+  integer*4    :: n(incomp), xind(incomp), steps(incomp)
+  integer*4    :: ic, oc, is, ig
 
   ! First build the nD to 1D translation
   steps(incomp) = 1
@@ -38,4 +42,45 @@ function ipol(x, xbox, n, ygrid, dygrid) result(y)
         y(oc,is) = ygrid(oc,ig) + sum(dygrid(:,oc,ig)*xrel)
      end do
   end do
-end function
+end subroutine
+
+! Tiled version of ipol. The box is split into nt tiles in each
+! direction, and each tile has its own grid with tn(:,it) points,
+! starting at offset toff(it) in ygrid and dygrid. The tiles are
+! indexed using the same C ordering as the grid points.
+subroutine ipol_tiled(x, xbox, nt, tn, toff, ygrid, dygrid, y, incomp, oncomp, nsamp, ngrid, ntile)
+  implicit none
+  !f2py intent(inout) y
+  !f2py threadsafe
+  integer*4    :: incomp, oncomp, nsamp, ngrid, ntile
+  real*8       :: x(incomp,nsamp), xbox(incomp,2), ygrid(oncomp,ngrid)
+  real*8       :: dygrid(incomp,oncomp,ngrid), y(oncomp,nsamp)
+  real*8       :: x0(incomp), itsize(incomp), tx(incomp), xrel(incomp)
+  integer*4    :: nt(incomp), tn(incomp,ntile), toff(ntile)
+  integer*4    :: tind(incomp), xind(incomp), tsteps(incomp), steps(incomp)
+  integer*4    :: ic, oc, is, it, ig
+
+  tsteps(incomp) = 1
+  do ic = incomp-1, 1, -1
+     tsteps(ic) = tsteps(ic+1)*nt(ic+1)
+  end do
+  x0 = xbox(:,1); itsize = nt/(xbox(:,2)-xbox(:,1))
+  do is = 1, nsamp
+     ! Find which tile we are in
+     tx   = (x(:,is)-x0)*itsize
+     tind = min(max(floor(tx),0),nt-1)
+     it   = sum(tind*tsteps)+1
+     ! And then do the normal lookup inside it
+     steps(incomp) = 1
+     do ic = incomp-1, 1, -1
+        steps(ic) = steps(ic+1)*tn(ic+1,it)
+     end do
+     xrel = (tx-tind)*(tn(:,it)-1)
+     xind = floor(xrel+0.5)
+     xrel = xrel - xind
+     ig   = toff(it)+sum(xind*steps)+1
+     do oc = 1, oncomp
+        y(oc,is) = ygrid(oc,ig) + sum(dygrid(:,oc,ig)*xrel)
+     end do
+  end do
+end subroutine
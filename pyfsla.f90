@@ -1,10 +1,18 @@
 ! These functions expect their inputs as right handed north polar coordinates!
-function aomulti(mjd, icoord, ao, am) result(ocoord)
+!
+! Convert the apparent coordinates icoord at times mjd to mean coordinates,
+! using the star-independent parameters ao and am, which should have been
+! computed for a time close to mjd. Only the local sidereal time in ao is
+! updated per sample. Explicit shapes are used so that the gil can be
+! released, allowing several time chunks to be processed in parallel.
+subroutine aomulti(mjd, icoord, ao, am, ocoord, n)
   implicit none
-  real*8    :: ao(:), am(:), mjd(:), icoord(:,:), ocoord(size(icoord,1),size(icoord,2))
+  !f2py intent(out) ocoord
+  !f2py threadsafe
+  integer*4 :: n
+  real*8    :: ao(14), am(21), mjd(n), icoord(2,n), ocoord(2,n)
   real*8    :: ra, dec, pi
-  integer*4 :: i, n
-  n  = size(mjd)
+  integer*4 :: i
   pi = 4*atan(1d0)
   do i = 1, n
      call sla_aoppat(mjd(i), ao)
@@ -12,7 +20,7 @@ function aomulti(mjd, icoord, ao, am) result(ocoord)
      call sla_ampqk(ra, dec, am, ocoord(1,i), ocoord(2,i))
      ocoord(2,i) = pi/2-ocoord(2,i)
   end do
-end function
+end subroutine
 
 function equ2gal(icoord) result(ocoord)
   implicit none
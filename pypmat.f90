@@ -0,0 +1,66 @@
+! Fused pointing matrix for map-making with interpolated pointing.
+! For each sample, the pointing is interpolated in the same way as in
+! pyfinterpol.ipol, turned into a pixel and TQU weights, and then
+! projected, without ever storing the pointing. The ordering is
+!   bore: (idim,nsamp), offs: (idim,ndet), polcs: (2,ndet)
+!   xbox: (idim,2), n: (idim), ygrid: (odim,ngrid), dygrid: (idim,odim,ngrid)
+!   mbox: (2,2), tod: (nsamp,ndet), map: (nx,ny,ncomp)
+! where the interpolated pointing is [ra,pi/2-dec,cos2psi,sin2psi],
+! polcs holds cos and sin of twice the detector polarization angle,
+! and mbox is [[ra1,ra2],[dec1,dec2]] for the centers of the first
+! and last pixels. Samples that fall outside the map are ignored.
+!
+! If dir > 0, tod = P map. Otherwise map = map + P' tod.
+subroutine pmat_tqu(dir, bore, offs, polcs, xbox, n, ygrid, dygrid, mbox, tod, map, &
+   & idim, nsamp, ndet, odim, ngrid, ncomp, nx, ny)
+  implicit none
+  !f2py intent(inout) tod, map
+  !f2py threadsafe
+  integer*4    :: dir, idim, nsamp, ndet, odim, ngrid, ncomp, nx, ny
+  real*8       :: bore(idim,nsamp), offs(idim,ndet), polcs(2,ndet), xbox(idim,2)
+  real*8       :: ygrid(odim,ngrid), dygrid(idim,odim,ngrid), mbox(2,2)
+  real*8       :: tod(nsamp,ndet), map(nx,ny,ncomp)
+  integer*4    :: n(idim)
+  real*8       :: x0(idim), idx(idim), xrel(idim), p(4), ipix(2), pi, c2, s2
+  integer*4    :: xind(idim), steps(idim), ic, oc, is, id, ig, px, py
+
+  pi = 4*atan(1d0)
+  steps(idim) = 1
+  do ic = idim-1, 1, -1
+     steps(ic) = steps(ic+1)*n(ic+1)
+  end do
+  x0 = xbox(:,1); idx = (n-1)/(xbox(:,2)-xbox(:,1))
+  ipix = (/ nx-1, ny-1 /)/(mbox(:,2)-mbox(:,1))
+  do id = 1, ndet
+     do is = 1, nsamp
+        ! Interpolate the pointing
+        xrel = (bore(:,is)+offs(:,id)-x0)*idx
+        xind = floor(xrel+0.5)
+        xrel = xrel - xind
+        ig   = sum(xind*steps)+1
+        do oc = 1, 4
+           p(oc) = ygrid(oc,ig) + sum(dygrid(:,oc,ig)*xrel)
+        end do
+        ! Find the pixel
+        px = nint((p(1)-mbox(1,1))*ipix(1))+1
+        py = nint((pi/2-p(2)-mbox(2,1))*ipix(2))+1
+        if(px < 1 .or. px > nx .or. py < 1 .or. py > ny) then
+           if(dir > 0) tod(is,id) = 0
+           cycle
+        end if
+        ! Rotate by the detector's polarization angle
+        c2 = p(3)*polcs(1,id) - p(4)*polcs(2,id)
+        s2 = p(4)*polcs(1,id) + p(3)*polcs(2,id)
+        if(dir > 0) then
+           tod(is,id) = map(px,py,1)
+           if(ncomp > 1) tod(is,id) = tod(is,id) + c2*map(px,py,2) + s2*map(px,py,3)
+        else
+           map(px,py,1) = map(px,py,1) + tod(is,id)
+           if(ncomp > 1) then
+              map(px,py,2) = map(px,py,2) + c2*tod(is,id)
+              map(px,py,3) = map(px,py,3) + s2*tod(is,id)
+           end if
+        end if
+     end do
+  end do
+end subroutine